@@ -1,40 +1,197 @@
-import sys
 import os
+import argparse
+import collections
+import csv
+import functools
+import contextlib
+import time
+import json
+import itertools
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import dicom
+import dicom.filereader
 import numpy as np
 from PIL import Image
 from PIL import ImageDraw
-from PIL import ImageFilter
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import logging
 import sqlite3
+import warnings
 
-# define the logging config, output in file
-logging.basicConfig(level=logging.DEBUG,
-                    format='%(asctime)s %(filename)s[line:%(lineno)d] %(levelname)s %(message)s',
-                    datefmt='%a, %d %b %Y %H:%M:%S',
-                    filename='running.log',
-                    filemode='w')
-# define a stream that will show log level > Warning on screen also
-console = logging.StreamHandler()
-console.setLevel(logging.WARNING)
-formatter = logging.Formatter('%(name)-12s: %(levelname)-8s %(message)s')
-console.setFormatter(formatter)
-logging.getLogger('').addHandler(console)
 
+def configure_logging(log_file="running.log", level="INFO"):
+    """
+    Logging config of the command line, output in log_file (appended, so the former runs are kept)
+    and log level > Warning on screen also. The module itself does not configure the logging,
+    so a program importing it decides where its messages go.
+    """
+    logging.basicConfig(level=getattr(logging, level.upper()),
+                        format='%(asctime)s %(filename)s[line:%(lineno)d] %(levelname)s %(message)s',
+                        datefmt='%a, %d %b %Y %H:%M:%S',
+                        filename=log_file,
+                        filemode='a')
+    # define a stream that will show log level > Warning on screen also
+    console = logging.StreamHandler()
+    console.setLevel(logging.WARNING)
+    formatter = logging.Formatter('%(name)-12s: %(levelname)-8s %(message)s')
+    console.setFormatter(formatter)
+    logging.getLogger('').addHandler(console)
+##############################################################
+
+# the timed stages of the analysis of a file, in the order of the pipeline
+Stage_Names = ("read", "decode", "hu_window", "center", "integration", "median_filter", "polar", "render",
+               "db_write")
+
+
+class StageTimer:
+    """
+    Wall and CPU time of the stages of the analysis (see Stage_Names).
+    Every Dicom has its own timer, the timers of the files are added to the timer of the run:
+        with timer.stage("center"):
+            ...
+    The CPU time is the one of the running thread, so the read ahead threads are timed correctly.
+    Function description:
+    stage: context manager adding the time of the block to a stage
+    add: add the timings of another timer, or its as_dict (e.g. sent back by a worker process)
+    as_dict: {stage: [count, wall seconds, cpu seconds]} of the stages that were run
+    share: as_dict divided by parts, e.g. the timings of one slice of a series
+    report: text table of the stages, for the --profile summary
+    """
+
+    def __init__(self):
+        self.Timings = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            timing = self.Timings.setdefault(name, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += time.perf_counter() - wall
+            timing[2] += time.thread_time() - cpu
 
+    def add(self, other):
+        if isinstance(other, StageTimer):
+            other = other.Timings
+        for name, (count, wall, cpu) in (other or {}).items():
+            timing = self.Timings.setdefault(name, [0, 0.0, 0.0])
+            timing[0] += count
+            timing[1] += wall
+            timing[2] += cpu
+    ############################################
+
+    def as_dict(self):
+        return dict((name, list(timing)) for name, timing in self.Timings.items())
+
+    def share(self, parts):
+        return dict((name, [x / parts for x in timing]) for name, timing in self.Timings.items())
+
+    def report(self):
+        total = sum(x[1] for x in self.Timings.values()) or 1.0
+        names = [x for x in Stage_Names if x in self.Timings] + sorted(set(self.Timings) - set(Stage_Names))
+        lines = [r"{0:<14}{1:>8}{2:>12}{3:>12}{4:>14}{5:>8}".format("stage", "count", "wall s", "cpu s",
+                                                                      "wall ms/call", "wall %")]
+        for name in names:
+            count, wall, cpu = self.Timings[name]
+            lines.append(r"{0:<14}{1:>8}{2:>12.3f}{3:>12.3f}{4:>14.3f}{5:>8.1f}".format(
+                name, count, wall, cpu, wall * 1000 / max(count, 1), wall * 100 / total))
+        return "\n".join(lines)
+# End of class StageTimer
 ##############################################################
 
 
+
+
 class SQL3Handler:
     """
     Create a Sqlite3 handler to store the data.
-    for the integration result, it will be converted to string and then store into database.
-    So when extracting data, the string should be converted back to list or numpy array before doing calculation
+    for the integration result, it is stored as binary blob with its numpy dtype and length,
+    so when extracting data, np.frombuffer gives back the numpy array without parsing (see decode_profile).
+    The schema version is kept in "pragma user_version". Databases of an older version (version 1 stored
+    the integration result as ';' joined text, version 2 had no acquisition date and indexes, version 3 had
+    no SOP Instance UID and ledger, version 4 had no timing, version 5 had no band scores and baselines)
+    must be converted once with migrate.
+    Every image is stored once: sop_instance_uid is unique, analyzing an image again replaces its record.
+    The ProcessedFiles ledger keeps the size and mtime of every file already seen, so that an incremental
+    run can skip the unchanged files without opening them (see SQL3Writer and select_new_files).
+    timing is the StageTimer.as_dict of the analysis of the record as JSON text, if it was asked to be stored.
+    peak_deviation, band_count, rms_baseline and out_of_tolerance are the BandScore of the record, scored when
+    it is inserted against the Baselines table, which keeps the running mean and variance of the profiles of
+    every scanner and protocol (see Baselines).
+    query reads all the records matching some filters at once, see ProfileTable.
+    SQL3Handler connects and commits once per record, use SQL3Writer to store many records in one run.
     """
     Database_Name = "BandAssessment.sqlite3.db"
+    Schema_Version = 6
+    Create_Table_String = '''create table if not exists BandAssessment(
+                           uid integer primary key autoincrement,
+                           serial_number integer,
+                           tube_voltage real,
+                           tube_current integer,
+                           kernel text,
+                           total_collimation real,
+                           slice_thickness real,
+                           instance integer,
+                           integration_result blob,
+                           integration_dtype text,
+                           integration_length integer,
+                           acquisition_date text,
+                           sop_instance_uid text,
+                           timing text,
+                           phantom_radius_pix real,
+                           phantom_radius_mm real,
+                           peak_deviation real,
+                           band_count integer,
+                           rms_baseline real,
+                           out_of_tolerance integer);'''
+    Create_Baseline_String = '''create table if not exists Baselines(
+                           serial_number integer,
+                           tube_voltage real,
+                           kernel text,
+                           total_collimation real,
+                           integration_length integer,
+                           record_count integer,
+                           mean_profile blob,
+                           m2_profile blob,
+                           primary key (serial_number, tube_voltage, kernel, total_collimation,
+                                        integration_length));'''
+    Create_Ledger_String = '''create table if not exists ProcessedFiles(
+                           file_name text primary key,
+                           file_size integer,
+                           file_mtime integer,
+                           sop_instance_uid text,
+                           status text);'''
+    # indexes for the filters of query, the date is kept as ISO text YYYY-MM-DD so that it sorts as a date
+    Create_Index_Strings = (r"create index if not exists idx_serial_date on BandAssessment(serial_number, "
+                            r"acquisition_date)",
+                            r"create index if not exists idx_date on BandAssessment(acquisition_date)",
+                            r"create index if not exists idx_voltage on BandAssessment(tube_voltage)",
+                            r"create index if not exists idx_current on BandAssessment(tube_current)",
+                            r"create index if not exists idx_kernel on BandAssessment(kernel)",
+                            r"create index if not exists idx_collimation on BandAssessment(total_collimation, "
+                            r"slice_thickness)",
+                            r"create unique index if not exists idx_instance_uid on BandAssessment(sop_instance_uid)",
+                            r"create index if not exists idx_tolerance on BandAssessment(out_of_tolerance)")
+    # the score columns are read as float, NaN when the record was not scored
+    Score_Columns = ("peak_deviation", "band_count", "rms_baseline", "out_of_tolerance")
+    Query_Columns = ("uid", "serial_number", "tube_voltage", "tube_current", "kernel", "total_collimation",
+                     "slice_thickness", "instance", "acquisition_date") + Score_Columns
+    Insert_String = r"insert or replace into BandAssessment (serial_number, tube_voltage, tube_current, kernel, " \
+                    r"total_collimation, slice_thickness, instance, integration_result, integration_dtype, " \
+                    r"integration_length, acquisition_date, sop_instance_uid, timing, phantom_radius_pix, " \
+                    r"phantom_radius_mm, peak_deviation, band_count, rms_baseline, out_of_tolerance) " \
+                    r"values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?);"
+    Insert_Ledger_String = r"insert or replace into ProcessedFiles values (?,?,?,?,?);"
 
-    def __init__(self, name, kvp, current, kernel, total_col, slice_thick, instance, integration):
+    def __init__(self, name, kvp, current, kernel, total_col, slice_thick, instance, integration, study_date=None,
+                 sop_instance_uid=None, timing=None, phantom_radius_pix=None, phantom_radius_mm=None):
         self.Dicom_Station_Name = name
         self.Dicom_KVP = kvp
         self.Dicom_Current = current
@@ -43,6 +200,11 @@ class SQL3Handler:
         self.Dicom_Slice_Thickness = slice_thick
         self.Dicom_Instance = instance
         self.Integration_Result = integration
+        self.Dicom_Study_Date = study_date
+        self.Dicom_SOP_Instance_UID = sop_instance_uid
+        self.Timing = timing
+        self.Phantom_Radius_Pix = phantom_radius_pix
+        self.Phantom_Radius_mm = phantom_radius_mm
         logging.debug(r"Run into SQL3Handler")
         try:
             con = sqlite3.connect(self.Database_Name)
@@ -50,56 +212,216 @@ class SQL3Handler:
             logging.debug(str(e))
             return
         logging.debug(r"Database connected")
-        sql_cursor = con.cursor()
-        sql_string = '''create table BandAssessment(
-                           uid integer primary key autoincrement,
-                           serial_number integer,
-                           tube_voltage real,
-                           tube_current integer,
-                           kernel text,
-                           total_collimation real,
-                           slice_thickness real,
-                           instance integer,
-                           integration_result text);'''
         try:
-            sql_cursor.execute(sql_string)
+            self.create_schema(con)
         except sqlite3.Error as e:
-            logging.debug(str(e))
+            logging.error(str(e))
+            con.close()
             return
         logging.debug(r"create table done.")
         con.close()
     # End of __ini__
     ############################################
 
+    @classmethod
+    def create_schema(cls, con):
+        """
+        Create the tables if they do not exist and set the schema version.
+        sqlite3.DatabaseError is raised if the database has an older schema that must be migrated first.
+        """
+        version = con.execute(r"pragma user_version").fetchone()[0]
+        exists = con.execute(r"select count(*) from sqlite_master where type='table' and name='BandAssessment'"
+                             ).fetchone()[0]
+        if exists and version < cls.Schema_Version:
+            raise sqlite3.DatabaseError(r"Database schema is version " + str(max(version, 1)) +
+                                        r", run 'python BandAssessment.py --migrate' first")
+        with con:
+            con.execute(cls.Create_Table_String)
+            con.execute(cls.Create_Ledger_String)
+            con.execute(cls.Create_Baseline_String)
+            for x in cls.Create_Index_Strings:
+                con.execute(x)
+            con.execute(r"pragma user_version = " + str(cls.Schema_Version))
+    ############################################
+
+    @staticmethod
+    def encode_profile(integration):
+        # convert numpy into binary blob, dtype (with byte order) and length to store in sqlite3
+        profile = np.ascontiguousarray(integration)
+        return profile.tobytes(), profile.dtype.str, profile.size
+
+    @staticmethod
+    def decode_profile(blob, dtype, length):
+        # no copy is made, the array is a read only view of the blob
+        return np.frombuffer(blob, dtype=np.dtype(dtype), count=length)
+
+    @staticmethod
+    def decode_v1_profile(text):
+        """
+        Convert a ';' joined integration result of schema version 1 to the current scale.
+        Version 1 divided every ring sum by index * 2 * 3.14, the current integration divides it by the number
+        of pixels bresenham visits (ring_index_table), so the old profiles are rescaled to stay comparable.
+        """
+        profile = np.array(text.split(';'), dtype=np.float64)
+        length = profile.size
+        ring_count = ring_index_table(2 * length + 1, 2 * length + 1, length, length, length)[2]
+        scale = np.arange(length) * 2 * 3.14 / ring_count
+        scale[:1] = 1  # radius 0 was never divided
+        return profile * scale
+
+    @staticmethod
+    def iso_date(value):
+        # dicom date YYYYMMDD (or a datetime.date) -> YYYY-MM-DD, None if the date is unknown
+        if not value:
+            return None
+        if hasattr(value, "isoformat"):
+            return value.isoformat()[:10]
+        value = str(value).strip()
+        if len(value) == 8 and value.isdigit():
+            return value[:4] + "-" + value[4:6] + "-" + value[6:]
+        return value
+
+    @classmethod
+    def make_row(cls, name, kvp, current, kernel, total_col, slice_thick, instance, integration, study_date=None,
+                 sop_instance_uid=None, timing=None, phantom_radius_pix=None, phantom_radius_mm=None):
+        # the BandScore columns are added when the row is inserted, see Baselines.score_rows
+        return ((name, kvp, current, kernel, total_col, slice_thick, instance) + cls.encode_profile(integration) +
+                (cls.iso_date(study_date), sop_instance_uid, None if timing is None else json.dumps(timing),
+                 phantom_radius_pix, phantom_radius_mm))
+    ############################################
+
+    @classmethod
+    def migrate(cls, database_name=None):
+        """
+        Convert a database of an older schema version to the current one, in one transaction.
+        Version 1 -> 2: the ';' joined text integration results are rescaled (see decode_v1_profile) and
+                        converted to binary blobs.
+        Version 2 -> 3: acquisition_date column (unknown for the old records) and the indexes are added.
+        Version 3 -> 4: sop_instance_uid column (unknown for the old records) and the ProcessedFiles ledger
+                        are added.
+        Version 4 -> 5: timing column (unknown for the old records) is added.
+        Version 5 -> 6: the phantom radius and band score columns and the Baselines table are added, all the
+                        records are scored in the order they were stored, as if they were inserted one by one
+                        (their phantom radius is unknown, see score_end).
+        Return the number of records in the migrated table.
+        """
+        con = sqlite3.connect(database_name or cls.Database_Name)
+        version = max(con.execute(r"pragma user_version").fetchone()[0], 1)
+        exists = con.execute(r"select count(*) from sqlite_master where type='table' and name='BandAssessment'"
+                             ).fetchone()[0]
+        count = 0
+        if not exists or version >= cls.Schema_Version:
+            logging.info(r"Database is already up to date.")
+            con.close()
+            return count
+        with con:
+            if version == 1:
+                con.execute(r"alter table BandAssessment rename to BandAssessment_v1")
+                con.execute(cls.Create_Table_String)
+                rows = con.execute(r"select uid, serial_number, tube_voltage, tube_current, kernel, total_collimation, "
+                                   r"slice_thickness, instance, integration_result from BandAssessment_v1")
+                # rows are converted while they are read, so the whole table never sits in memory
+                con.executemany(r"insert into BandAssessment (uid, serial_number, tube_voltage, tube_current, "
+                                r"kernel, total_collimation, slice_thickness, instance, integration_result, "
+                                r"integration_dtype, integration_length) values (?,?,?,?,?,?,?,?,?,?,?);",
+                                (row[:8] + cls.encode_profile(cls.decode_v1_profile(row[8]))
+                                 for row in rows))
+                con.execute(r"drop table BandAssessment_v1")
+                # the table is created with the current schema, no other step is needed
+                version = cls.Schema_Version
+            if version == 2:
+                con.execute(r"alter table BandAssessment add column acquisition_date text")
+                version = 3
+            if version == 3:
+                con.execute(r"alter table BandAssessment add column sop_instance_uid text")
+                version = 4
+            if version == 4:
+                con.execute(r"alter table BandAssessment add column timing text")
+                version = 5
+            if version == 5:
+                for x in (r"phantom_radius_pix real", r"phantom_radius_mm real", r"peak_deviation real",
+                          r"band_count integer", r"rms_baseline real", r"out_of_tolerance integer"):
+                    con.execute(r"alter table BandAssessment add column " + x)
+            con.execute(cls.Create_Ledger_String)
+            con.execute(cls.Create_Baseline_String)
+            for x in cls.Create_Index_Strings:
+                con.execute(x)
+            Baselines(con).rebuild()
+            count = con.execute(r"select count(*) from BandAssessment").fetchone()[0]
+            con.execute(r"pragma user_version = " + str(cls.Schema_Version))
+        con.execute(r"vacuum")
+        con.close()
+        logging.info(r"Database migrated to version %s, %s records", cls.Schema_Version, count)
+        return count
+    ############################################
+
     def insert_data(self):
         try:
             con = sqlite3.connect(self.Database_Name)
         except sqlite3.Error as e:
             logging.debug(str(e))
             return
-        # convert numpy into string to store in sqlite3
-        integration_result = []
-        for x in self.Integration_Result:
-            integration_result.append(str(x))
-        int_result_string = ';'.join(integration_result)
         # set up for store in sql
-        sql_cursor = con.cursor()
-        sql_string = r"insert into BandAssessment values (?,?,?,?,?,?,?,?,?);"
+        baselines = Baselines(con)
         try:
-            sql_cursor.execute(sql_string,
-                               (None, self.Dicom_Station_Name, self.Dicom_KVP, self.Dicom_Current, self.Dicom_Kernel,
-                                self.Dicom_Total_Collimation, self.Dicom_Slice_Thickness, self.Dicom_Instance,
-                                int_result_string))
+            with con:
+                row = self.make_row(self.Dicom_Station_Name, self.Dicom_KVP, self.Dicom_Current, self.Dicom_Kernel,
+                                    self.Dicom_Total_Collimation, self.Dicom_Slice_Thickness, self.Dicom_Instance,
+                                    self.Integration_Result, self.Dicom_Study_Date, self.Dicom_SOP_Instance_UID,
+                                    self.Timing, self.Phantom_Radius_Pix, self.Phantom_Radius_mm)
+                con.executemany(self.Insert_String, baselines.score_rows([row]))
+                baselines.save()
         except sqlite3.Error as e:
             logging.error(str(e))
             con.close()
             return
-        con.commit()
         logging.info(r"Insert record done.")
         con.close()
     # end of insertExample()
     ############################################
 
+    @classmethod
+    def query(cls, database_name=None, serial_number=None, tube_voltage=None, tube_current=None, kernel=None,
+              total_collimation=None, slice_thickness=None, date_from=None, date_to=None, uid_from=None,
+              out_of_tolerance=None):
+        """
+        Read all the records matching the filters (None means no filter, dates are inclusive).
+        uid_from keeps the records stored since a given uid, e.g. the records of the last run.
+        out_of_tolerance=1 keeps the records flagged against their baseline.
+        Return a ProfileTable with all the integration results stacked in one 2D array.
+        """
+        conditions = []
+        parameters = []
+        for column, value in (("serial_number", serial_number), ("tube_voltage", tube_voltage),
+                              ("tube_current", tube_current), ("kernel", kernel),
+                              ("total_collimation", total_collimation), ("slice_thickness", slice_thickness),
+                              ("out_of_tolerance", out_of_tolerance)):
+            if value is not None:
+                conditions.append(column + r" = ?")
+                parameters.append(value)
+        if date_from is not None:
+            conditions.append(r"acquisition_date >= ?")
+            parameters.append(cls.iso_date(date_from))
+        if date_to is not None:
+            conditions.append(r"acquisition_date <= ?")
+            parameters.append(cls.iso_date(date_to))
+        if uid_from is not None:
+            conditions.append(r"uid >= ?")
+            parameters.append(uid_from)
+        sql_string = r"select " + ", ".join(cls.Query_Columns) + \
+                     r", integration_result, integration_dtype, integration_length from BandAssessment"
+        if conditions:
+            sql_string += r" where " + r" and ".join(conditions)
+        sql_string += r" order by uid"
+        con = sqlite3.connect(database_name or cls.Database_Name)
+        try:
+            rows = con.execute(sql_string, parameters).fetchall()
+        finally:
+            con.close()
+        logging.debug(r"%s records found by query", len(rows))
+        return ProfileTable(rows)
+    ############################################
+
     def read_data(self):
         try:
             con = sqlite3.connect(self.Database_Name)
@@ -107,20 +429,1207 @@ class SQL3Handler:
             logging.debug(str(e))
             return
         sql_cursor = con.cursor()
-        sql_string = r"select integration_result from BandAssessment"
+        sql_string = r"select integration_result, integration_dtype, integration_length from BandAssessment"
         sql_cursor.execute(sql_string)
-        data = sql_cursor.fetchone()[0]
-        str_result = data.split(';')
-        float_result = []
-        for x in str_result:
-            float_result.append(float(x))
-        np_result = np.array(float_result)
+        np_result = self.decode_profile(*sql_cursor.fetchone())
         print(type(np_result))
         print(np_result)
         con.close()
 # End of class SQL3Handler:
 ##############################################################
 
+# band metrics of one profile, see score_profile.
+# peak_deviation: largest deviation (HU) of the median filter result from its level inside the phantom
+# band_count: number of separate runs of radius deviating more than Band_Threshold from that level
+# rms_baseline: RMS difference (HU) of the profile from the mean profile of its baseline, None without baseline
+# out_of_tolerance: True / False once the baseline has Baseline_Min_Count records, None before
+BandScore = collections.namedtuple("BandScore", ["peak_deviation", "band_count", "rms_baseline", "out_of_tolerance"],
+                                   defaults=(None, None, None, None))
+# the first circles only have a few pixels, they are too noisy to be scored
+Score_Start = 5
+# the scored radius stop Score_Shell_Margin (mm) inside the fitted phantom edge, so the shell of the phantom
+# is never scored, and Score_Edge_Margin radius more because the median filter spreads the shell over 3 radius
+Score_Shell_Margin = 6.0
+Score_Edge_Margin = 3
+# deviation (HU) of the median filter result counted as a band
+Band_Threshold = 2.0
+# records a baseline needs before a scan is flagged. A scan is out of tolerance if the RMS of its per radius
+# z-scores is above Tolerance_Sigma (a drift of the whole profile), or if its median filtered z-scores
+# reach Band_Tolerance_Sigma at any radius (a band that the RMS averages away)
+Baseline_Min_Count = 5
+Tolerance_Sigma = 3.0
+Band_Tolerance_Sigma = 5.0
+# lowest variance (HU^2) of the baseline, so that a very stable scanner is not flagged for a 0.1 HU difference
+Baseline_Variance_Floor = 0.25
+
+
+def score_end(profile, phantom_radius_pix=None, phantom_radius_mm=None, window_lower=-50, window_upper=50):
+    """
+    End (excluded) of the scored radius of a profile, inside the water of the phantom.
+    With the fitted phantom edge (see find_circle), it is Score_Shell_Margin inside the edge. Without it (records
+    migrated from an older version, phantom not found), it is the first radius whose value is a quarter of the
+    window away from the level of the water, i.e. the inner side of the shell or the air.
+    Score_Edge_Margin is taken off both, and the last 2 values of the median filter, which are extrapolated,
+    are never scored.
+    """
+    if phantom_radius_pix and phantom_radius_mm:
+        end = int(np.floor(phantom_radius_pix * (1 - Score_Shell_Margin / phantom_radius_mm)))
+    else:
+        level = np.median(profile[Score_Start:max(len(profile) // 2, Score_Start + 1)])
+        outside = np.nonzero(np.abs(profile[Score_Start:] - level) > (window_upper - window_lower) / 4)[0]
+        end = Score_Start + outside[0] if len(outside) else len(profile)
+    return min(end - Score_Edge_Margin, len(profile) - 2)
+
+
+def score_profile(integration_result, baseline=None, phantom_radius_pix=None, phantom_radius_mm=None):
+    """
+    Score a profile (integration result) for bands, only inside the phantom: the radius from Score_Start to
+    score_end, phantom_radius_pix and phantom_radius_mm are the fitted phantom edge if it is known.
+    baseline is (count, mean profile, M2 profile) as kept by Baselines, the profile is compared with it before
+    it is added to it, see Tolerance_Sigma for the out of tolerance rules. Return a BandScore.
+    """
+    return score_profiles([integration_result], [baseline], [phantom_radius_pix], [phantom_radius_mm])[0]
+
+
+def score_profiles(profiles, baselines, phantom_radius_pix, phantom_radius_mm):
+    """
+    Score a batch of profiles, same as score_profile for every one, the other arguments are lists with one
+    value per profile. The profiles with the same length and scored radius are stacked, so median_filter runs
+    once per group on the profiles and once on their z-scores. Return a list of BandScore.
+    """
+    profiles = [np.asarray(x, dtype=float) for x in profiles]
+    scores = [BandScore()] * len(profiles)
+    groups = {}
+    for index, profile in enumerate(profiles):
+        end = score_end(profile, phantom_radius_pix[index], phantom_radius_mm[index])
+        if end - Score_Start >= 6:
+            groups.setdefault((profile.size, end), []).append(index)
+    for (length, end), indexes in groups.items():
+        stack = np.stack([profiles[x] for x in indexes])
+        inner = median_filter(stack)[:, Score_Start:end]
+        deviation = np.abs(inner - np.median(inner, axis=-1, keepdims=True))
+        band = deviation > Band_Threshold
+        band_count = band[:, 0] + np.count_nonzero(band[:, 1:] & ~band[:, :-1], axis=-1)
+        for row, index in enumerate(indexes):
+            scores[index] = BandScore(float(deviation[row].max()), int(band_count[row]))
+        # the profiles compared with their baseline, then the ones that have enough records to be flagged
+        compared = [(row, index) for row, index in enumerate(indexes)
+                    if baselines[index] is not None and baselines[index][0] >= 1]
+        if not compared:
+            continue
+        difference = np.stack([stack[row, Score_Start:end] - baselines[index][1][Score_Start:end]
+                               for row, index in compared])
+        rms_baseline = np.sqrt(np.mean(difference * difference, axis=-1))
+        for row, (_, index) in enumerate(compared):
+            scores[index] = scores[index]._replace(rms_baseline=float(rms_baseline[row]))
+        flagged = [(row, index) for row, (_, index) in enumerate(compared)
+                   if baselines[index][0] >= Baseline_Min_Count]
+        if not flagged:
+            continue
+        z_score = np.stack([difference[row] / np.sqrt(np.maximum(
+            baselines[index][2][Score_Start:end] / (baselines[index][0] - 1), Baseline_Variance_Floor))
+            for row, index in flagged])
+        out_of_tolerance = ((np.sqrt(np.mean(z_score * z_score, axis=-1)) > Tolerance_Sigma) |
+                            (np.abs(median_filter(z_score)).max(axis=-1) > Band_Tolerance_Sigma))
+        for row, (_, index) in enumerate(flagged):
+            scores[index] = scores[index]._replace(out_of_tolerance=bool(out_of_tolerance[row]))
+    return scores
+
+
+class Baselines:
+    """
+    Materialized baselines of the Baselines table: the running count, per radius mean and M2 (sum of the squared
+    differences from the mean) of the profiles of every (serial number, tube voltage, kernel, total collimation,
+    profile length). The profile length separates the 20cm and 30cm phantoms of the same protocol.
+    The baselines are updated with Welford's method as every record is inserted, so scoring a new record costs
+    the same whatever the size of the history. A record replaced by insert or replace (same SOP Instance UID)
+    is removed from its baseline first, so an image analyzed again is counted once.
+    Function description:
+    score_rows: score the rows of SQL3Handler.make_row against their baseline, then add them to it.
+                Return the rows with the BandScore columns, ready for SQL3Handler.Insert_String.
+                The baselines are updated row by row, the rows are scored at once (see score_profiles)
+                with a copy of the baseline each one had
+    save: write the changed baselines, in the transaction of the rows
+    rebuild: score all the stored records again in the order they were stored (see SQL3Handler.migrate)
+    The baselines read are cached, call clear if the transaction is rolled back.
+    """
+    Rebuild_Batch_Size = 1000
+
+    def __init__(self, con):
+        self.con = con
+        self.Cache = {}
+        self.Changed = set()
+
+    @staticmethod
+    def key(serial_number, tube_voltage, kernel, total_collimation, length):
+        # same types as the values read back from the database, so the cache never holds a key twice
+        return (str(serial_number), None if tube_voltage is None else float(tube_voltage), str(kernel),
+                None if total_collimation is None else float(total_collimation), int(length))
+
+    def get(self, key):
+        # [count, mean, m2] of the baseline of key, count is 0 for a new baseline
+        if key not in self.Cache:
+            row = self.con.execute(r"select record_count, mean_profile, m2_profile from Baselines where "
+                                   r"serial_number = ? and tube_voltage is ? and kernel = ? and "
+                                   r"total_collimation is ? and integration_length = ?", key).fetchone()
+            if row is None:
+                self.Cache[key] = [0, np.zeros(key[4]), np.zeros(key[4])]
+            else:
+                self.Cache[key] = [row[0], np.frombuffer(row[1]).copy(), np.frombuffer(row[2]).copy()]
+        return self.Cache[key]
+
+    def add(self, key, profile):
+        # return the baseline before the profile is added (a copy, None for a new baseline) to score the profile
+        baseline = self.get(key)
+        before = (baseline[0], baseline[1].copy(), baseline[2].copy()) if baseline[0] else None
+        baseline[0] += 1
+        delta = profile - baseline[1]
+        baseline[1] += delta / baseline[0]
+        baseline[2] += delta * (profile - baseline[1])
+        self.Changed.add(key)
+        return before
+
+    def remove(self, key, profile):
+        baseline = self.get(key)
+        if baseline[0] <= 1:
+            self.Cache[key] = [0, np.zeros(key[4]), np.zeros(key[4])]
+        else:
+            mean = (baseline[0] * baseline[1] - profile) / (baseline[0] - 1)
+            baseline[2] = np.maximum(baseline[2] - (profile - mean) * (profile - baseline[1]), 0)
+            baseline[1] = mean
+            baseline[0] -= 1
+        self.Changed.add(key)
+    ############################################
+
+    def stored_record(self, sop_instance_uid):
+        # (key, profile) of the record already stored for an image, None if it is new
+        row = self.con.execute(r"select serial_number, tube_voltage, kernel, total_collimation, integration_result, "
+                               r"integration_dtype, integration_length from BandAssessment "
+                               r"where sop_instance_uid = ?", (sop_instance_uid,)).fetchone()
+        if row is None:
+            return None
+        return self.key(*row[:4], row[6]), SQL3Handler.decode_profile(*row[4:]).astype(float)
+
+    def score_rows(self, rows):
+        profiles = []
+        baselines = []
+        # the records of this batch, an image can be twice in the same batch
+        batch = {}
+        for row in rows:
+            key = self.key(row[0], row[1], row[3], row[4], row[9])
+            profile = SQL3Handler.decode_profile(*row[7:10]).astype(float)
+            uid = row[11]
+            if uid is not None:
+                replaced = batch[uid] if uid in batch else self.stored_record(uid)
+                if replaced is not None:
+                    self.remove(*replaced)
+                batch[uid] = (key, profile)
+            profiles.append(profile)
+            baselines.append(self.add(key, profile))
+        scores = score_profiles(profiles, baselines, [x[13] for x in rows], [x[14] for x in rows])
+        scored = []
+        for row, score in zip(rows, scores):
+            if score.out_of_tolerance:
+                logging.warning(r"%s_%sKv_%s_%s instance %s is out of tolerance, RMS %.2f HU from its baseline",
+                                row[0], row[1], row[3], row[4], row[6], score.rms_baseline)
+            scored.append(row + (score.peak_deviation, score.band_count, score.rms_baseline,
+                                 None if score.out_of_tolerance is None else int(score.out_of_tolerance)))
+        return scored
+
+    def save(self):
+        self.con.executemany(r"insert or replace into Baselines values (?,?,?,?,?,?,?,?)",
+                             (key + (self.Cache[key][0], self.Cache[key][1].tobytes(), self.Cache[key][2].tobytes())
+                              for key in self.Changed))
+        self.Changed = set()
+
+    def clear(self):
+        self.Cache = {}
+        self.Changed = set()
+    ############################################
+
+    def rebuild(self):
+        """
+        Empty the Baselines table and score all the records of BandAssessment again in uid order,
+        within the transaction of the caller. Return the number of records scored.
+        """
+        self.clear()
+        self.con.execute(r"delete from Baselines")
+        rows = self.con.execute(r"select uid, serial_number, tube_voltage, kernel, total_collimation, "
+                                r"integration_result, integration_dtype, integration_length, phantom_radius_pix, "
+                                r"phantom_radius_mm from BandAssessment order by uid")
+        # the profiles are scored Rebuild_Batch_Size at a time while they are read, only the scores are kept
+        # until the update
+        scores = []
+        while True:
+            chunk = rows.fetchmany(self.Rebuild_Batch_Size)
+            if not chunk:
+                break
+            profiles = []
+            baselines = []
+            for row in chunk:
+                profiles.append(SQL3Handler.decode_profile(*row[5:8]).astype(float))
+                baselines.append(self.add(self.key(row[1], row[2], row[3], row[4], row[7]), profiles[-1]))
+            for row, score in zip(chunk, score_profiles(profiles, baselines, [x[8] for x in chunk],
+                                                         [x[9] for x in chunk])):
+                scores.append((score.peak_deviation, score.band_count, score.rms_baseline,
+                               None if score.out_of_tolerance is None else int(score.out_of_tolerance), row[0]))
+        self.con.executemany(r"update BandAssessment set peak_deviation = ?, band_count = ?, rms_baseline = ?, "
+                             r"out_of_tolerance = ? where uid = ?", scores)
+        self.save()
+        logging.info(r"%s records scored, %s baselines", len(scores), len(self.Cache))
+        return len(scores)
+# End of class Baselines
+##############################################################
+
+
+class SQL3Writer:
+    """
+    Long-lived writer of the BandAssessment table, for storing many records in one run.
+    The database is opened once, the table is created if it does not exist and the WAL journal is enabled.
+    Records are buffered and written with executemany, one transaction every batch_size records.
+    The ProcessedFiles ledger entries (add_processed) are written in the same transaction as the records,
+    so an interrupted run never marks a file as done without its record.
+    Use it as a context manager, the remaining records are written when leaving the block:
+        with SQL3Writer() as writer:
+            writer.add_result(result)
+            writer.add_processed(result.file_name, file_stat(result.file_name), uid, "done")
+    With store_timing, the stage timings of every record are stored with it. The time spent writing is
+    added to the "db_write" stage of Timer.
+    Every record is scored against its baseline when it is written, and the baselines are updated in the
+    same transaction (see Baselines).
+    """
+
+    def __init__(self, database_name=SQL3Handler.Database_Name, batch_size=500, store_timing=False):
+        self.Database_Name = database_name
+        self.Batch_Size = max(1, batch_size)
+        self.Store_Timing = store_timing
+        self.Timer = StageTimer()
+        self.Rows = []
+        self.Processed = []
+        self.Row_Count = 0
+        self.con = sqlite3.connect(self.Database_Name)
+        self.con.execute(r"pragma journal_mode=WAL")
+        self.con.execute(r"pragma synchronous=NORMAL")
+        try:
+            SQL3Handler.create_schema(self.con)
+        except sqlite3.Error:
+            # the caller reports the error, e.g. main asks to run --migrate first
+            self.con.close()
+            raise
+        self.Baselines = Baselines(self.con)
+        logging.debug(r"Database %s opened for writing", self.Database_Name)
+    ############################################
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+    ############################################
+
+    def add_row(self, name, kvp, current, kernel, total_col, slice_thick, instance, integration, study_date=None,
+                sop_instance_uid=None, timing=None, phantom_radius_pix=None, phantom_radius_mm=None):
+        self.Rows.append(SQL3Handler.make_row(name, kvp, current, kernel, total_col, slice_thick, instance,
+                                              integration, study_date, sop_instance_uid,
+                                              timing if self.Store_Timing else None, phantom_radius_pix,
+                                              phantom_radius_mm))
+        if len(self.Rows) >= self.Batch_Size:
+            self.flush()
+
+    def add_result(self, result):
+        header = result.header
+        self.add_row(header["Dicom_Station_Name"], header["Dicom_KVP"], header["Dicom_Current"],
+                     header["Dicom_Kernel"], header["Dicom_Total_Collimation"], header["Dicom_Slice_Thickness"],
+                     header["Dicom_Instance"], result.integration_result, header["Dicom_Study_Date"],
+                     header["Dicom_SOP_Instance_UID"], result.timing, result.phantom_radius_pix,
+                     result.phantom_radius_mm)
+
+    def add_processed(self, file_name, stat, sop_instance_uid=None, status="done"):
+        """
+        Record a file in the ProcessedFiles ledger, stat is (size, mtime in ns) as given by file_stat.
+        status is "done" for the analyzed files, "error: ..." for the failed ones,
+        else the reason why the file was skipped.
+        """
+        self.Processed.append((file_name, stat[0], stat[1], sop_instance_uid, status))
+        if len(self.Processed) >= self.Batch_Size:
+            self.flush()
+    ############################################
+
+    def last_uid(self):
+        # uid of the last stored record, the records stored after it get a bigger uid
+        self.flush()
+        return self.con.execute(r"select max(uid) from BandAssessment").fetchone()[0] or 0
+
+    def processed_files(self):
+        """
+        Return {file name: (size, mtime in ns)} of the files in the ledger, except the ones that failed.
+        """
+        rows = self.con.execute(r"select file_name, file_size, file_mtime from ProcessedFiles "
+                                r"where status not like 'error%'")
+        return {x[0]: (x[1], x[2]) for x in rows}
+
+    def known_instances(self):
+        """
+        Return the set of the SOP Instance UIDs already stored in the BandAssessment table.
+        """
+        rows = self.con.execute(r"select sop_instance_uid from BandAssessment where sop_instance_uid is not null")
+        return set(x[0] for x in rows)
+    ############################################
+
+    def flush(self):
+        if not self.Rows and not self.Processed:
+            return
+        try:
+            with self.Timer.stage("db_write"):
+                # the rows are scored before the transaction, so the database is locked for the writes only
+                rows = self.Baselines.score_rows(self.Rows)
+                with self.con:
+                    self.con.executemany(SQL3Handler.Insert_String, rows)
+                    self.con.executemany(SQL3Handler.Insert_Ledger_String, self.Processed)
+                    self.Baselines.save()
+        except sqlite3.Error as e:
+            # the cached baselines were updated with the rolled back records
+            self.Baselines.clear()
+            logging.error(r"Insert %s records failed: %s", len(self.Rows), e)
+        else:
+            self.Row_Count += len(self.Rows)
+            logging.info(r"Insert %s records done.", len(self.Rows))
+        self.Rows = []
+        self.Processed = []
+    ############################################
+
+    def close(self):
+        if self.con is None:
+            return
+        self.flush()
+        self.con.close()
+        self.con = None
+        logging.debug(r"Database closed, %s records written", self.Row_Count)
+# End of class SQL3Writer:
+##############################################################
+
+
+class ProfileTable:
+    """
+    The records returned by SQL3Handler.query, with vectorized aggregate functions over all their profiles.
+    Metadata: numpy record array, one record per row with the fields of SQL3Handler.Query_Columns,
+              the band scores are NaN for the records that could not be scored
+    Profiles: 2D array (record x radius) of the integration results. The 20cm and 30cm phantoms have a
+              different radius, shorter profiles are padded with NaN so the aggregates ignore the missing radius.
+    Function description:
+    groups: the unique keys of one or more metadata fields and the group index of every record
+    mean_profile / percentile_profile: the profile of every group, e.g. per scanner (serial_number)
+    deviation: per radius deviation of every record from a baseline profile, or from the mean of its group
+    """
+
+    def __init__(self, rows):
+        columns = len(SQL3Handler.Query_Columns)
+        length = max([x[columns + 2] for x in rows] or [0])
+        self.Profiles = np.full((len(rows), length), np.nan)
+        # join the blobs of the same dtype and length, then decode them with one np.frombuffer
+        formats = {}
+        for index, row in enumerate(rows):
+            formats.setdefault((row[columns + 1], row[columns + 2]), []).append(index)
+        for (dtype, size), index in formats.items():
+            blob = b"".join([rows[x][columns] for x in index])
+            self.Profiles[index, :size] = np.frombuffer(blob, dtype=np.dtype(dtype)).reshape(len(index), size)
+        fields = []
+        for column in range(columns):
+            values = [x[column] for x in rows]
+            if SQL3Handler.Query_Columns[column] in SQL3Handler.Score_Columns:
+                fields.append(np.array([np.nan if x is None else x for x in values], dtype=float))
+                continue
+            field = np.array(values)
+            # unknown values (e.g. acquisition date of migrated records) are kept as empty text
+            if field.dtype == object:
+                field = np.array(["" if x is None else str(x) for x in values])
+            fields.append(field)
+        self.Metadata = np.rec.fromarrays(fields, names=list(SQL3Handler.Query_Columns))
+
+    def __len__(self):
+        return len(self.Metadata)
+    ############################################
+
+    def groups(self, by="serial_number"):
+        """
+        by is a field name or a tuple of field names of Metadata.
+        Return (keys, inverse): the list of unique keys and the index in keys of every record.
+        """
+        if isinstance(by, str):
+            keys, inverse = np.unique(self.Metadata[by], return_inverse=True)
+            return keys.tolist(), inverse.ravel()
+        keys, inverse = np.unique(np.rec.fromarrays([self.Metadata[x] for x in by], names=list(by)),
+                                  return_inverse=True)
+        return [tuple(x) for x in keys.tolist()], inverse.ravel()
+
+    def sorted_groups(self, by):
+        # records sorted by group and the start of every group, for np.add.reduceat
+        keys, inverse = self.groups(by)
+        order = np.argsort(inverse, kind="stable")
+        starts = np.searchsorted(inverse[order], np.arange(len(keys)))
+        return keys, order, starts
+    ############################################
+
+    def mean_profile(self, by="serial_number"):
+        """
+        Return (keys, means): means[i] is the mean profile of the records of keys[i].
+        """
+        if len(self) == 0:
+            return [], np.zeros((0, self.Profiles.shape[1]))
+        keys, order, starts = self.sorted_groups(by)
+        profiles = self.Profiles[order]
+        valid = ~np.isnan(profiles)
+        sums = np.add.reduceat(np.where(valid, profiles, 0), starts, axis=0)
+        counts = np.add.reduceat(valid, starts, axis=0, dtype=np.int64)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return keys, sums / counts
+
+    def percentile_profile(self, q, by="serial_number"):
+        """
+        q is a percentile or a sequence of percentiles (0~100).
+        Return (keys, percentiles): percentiles[i] is the percentile profile(s) of the records of keys[i].
+        """
+        if len(self) == 0:
+            return [], np.zeros((0,) + np.shape(q) + (self.Profiles.shape[1],))
+        keys, order, starts = self.sorted_groups(by)
+        profiles = self.Profiles[order]
+        ends = np.append(starts[1:], len(profiles))
+        with warnings.catch_warnings():
+            # a radius where every profile of a group is NaN gives NaN, no need to warn
+            warnings.simplefilter("ignore", RuntimeWarning)
+            return keys, np.stack([np.nanpercentile(profiles[x:y], q, axis=0) for x, y in zip(starts, ends)])
+    ############################################
+
+    def deviation(self, baseline=None, by="serial_number"):
+        """
+        Per radius deviation of every record (record x radius).
+        baseline is a profile to compare all the records with. If it is None, every record is compared
+        with the mean profile of its group.
+        """
+        if baseline is None:
+            keys, means = self.mean_profile(by)
+            if len(self) == 0:
+                return np.zeros(self.Profiles.shape)
+            return self.Profiles - means[self.groups(by)[1]]
+        length = min(len(baseline), self.Profiles.shape[1])
+        padded = np.full(self.Profiles.shape[1], np.nan)
+        padded[:length] = np.asarray(baseline, dtype=float)[:length]
+        return self.Profiles - padded
+# End of class ProfileTable:
+##############################################################
+
+# dicom tags that are read from every image, key is the attribute name used by Dicom and DicomSeries
+Header_Tags = (("Dicom_Station_Name", (0x0018, 0x1000)),
+               ("StudyDescription", (0x0008, 0x1030)),
+               ("Slop", (0x0028, 0x1053)),
+               ("Intercept", (0x0028, 0x1052)),
+               ("Dicom_Rows", (0x0028, 0x0010)),
+               ("Dicom_Cols", (0x0028, 0x0011)),
+               ("Dicom_Pix_Space", (0x0028, 0x0030)),
+               ("Dicom_KVP", (0x0018, 0x0060)),
+               ("Dicom_Current", (0x0018, 0x1151)),
+               ("Dicom_Kernel", (0x0018, 0x1210)),
+               ("Dicom_Series", (0x0020, 0x0011)),
+               ("Dicom_Total_Collimation", (0x0018, 0x9307)),
+               ("Dicom_Slice_Thickness", (0x0018, 0x0050)),
+               ("Dicom_Instance", (0x0020, 0x0013)))
+# tags that may be missing in some images, the value is None then
+Header_Optional_Tags = (("Dicom_Study_Date", (0x0008, 0x0020)),
+                        ("Dicom_SOP_Instance_UID", (0x0008, 0x0018)),
+                        ("Dicom_Series_Instance_UID", (0x0020, 0x000E)))
+
+
+def read_header(dataset):
+    """
+    Read the tags of Header_Tags and Header_Optional_Tags from a dicom dataset.
+    Return a dict of attribute name -> value. KeyError is raised if a tag of Header_Tags is missing.
+    """
+    header = {}
+    for name, tag in Header_Tags:
+        header[name] = dataset[tag].value
+    for name, tag in Header_Optional_Tags:
+        try:
+            header[name] = dataset[tag].value
+        except KeyError:
+            header[name] = None
+    return header
+
+
+def plain_value(value):
+    """
+    Convert a dicom value (DS, IS, multi value...) to plain python types, so it can be sent between processes.
+    """
+    if value is None:
+        return None
+    if isinstance(value, (list, tuple)):
+        return [plain_value(x) for x in value]
+    if isinstance(value, int):
+        return int(value)
+    if isinstance(value, float):
+        return float(value)
+    return str(value)
+##############################################################
+
+# one line of the manifest of a pre-scan, reason tells why a file is rejected
+ManifestEntry = collections.namedtuple("ManifestEntry",
+                                       ["file_name", "accepted", "reason", "station_name", "series", "instance",
+                                        "sop_instance_uid", "series_instance_uid"],
+                                       defaults=(None, None, None, None, None))
+
+
+def prescan_file(filename, fp=None):
+    """
+    Read the header of a file only (stop before the pixel data) and check it is a Band Assessment image.
+    fp is an already opened handle of the file, it is then left at the start of the pixel data so that
+    read_pixel_data can go on with it. If fp is None the file is opened and closed here.
+    Return (entry, dataset): the ManifestEntry of the file and the header, dataset is None if it can not be read.
+    """
+    try:
+        if fp is None:
+            with open(filename, "rb") as fp:
+                dataset = dicom.read_file(fp, stop_before_pixels=True)
+        else:
+            dataset = dicom.read_file(fp, stop_before_pixels=True)
+    except Exception as e:
+        return ManifestEntry(filename, False, r"not a dicom file: " + str(e)), None
+    try:
+        study_description = dataset[0x0008, 0x1030].value
+    except KeyError:
+        study_description = None
+    if study_description != r"Band Assessment":
+        return ManifestEntry(filename, False, r"not Band Assessment"), dataset
+    try:
+        header = read_header(dataset)
+    except KeyError as e:
+        return ManifestEntry(filename, False, r"missing tag " + str(e)), dataset
+    return ManifestEntry(filename, True, r"", plain_value(header["Dicom_Station_Name"]),
+                         plain_value(header["Dicom_Series"]), plain_value(header["Dicom_Instance"]),
+                         plain_value(header["Dicom_SOP_Instance_UID"]),
+                         plain_value(header["Dicom_Series_Instance_UID"])), dataset
+
+
+def read_pixel_data(fp, dataset):
+    """
+    Read the pixel data of a dataset read by prescan_file from the same file handle,
+    the header is not parsed again.
+    """
+    dataset.update(dicom.filereader.read_dataset(fp, dataset.is_implicit_VR, dataset.is_little_endian))
+    return dataset
+
+
+def read_dicom(filename, timer=None):
+    """
+    Read the header of a file, then its pixel data from the same handle only if the header is accepted.
+    Return (entry, dataset) as prescan_file, dataset is None if the file is rejected.
+    The time spent is added to the "read" stage of timer if given.
+    """
+    try:
+        with (timer or StageTimer()).stage("read"), open(filename, "rb") as fp:
+            entry, dataset = prescan_file(filename, fp)
+            if not entry.accepted:
+                return entry, None
+            read_pixel_data(fp, dataset)
+    except Exception as e:
+        return ManifestEntry(filename, False, str(e)), None
+    return entry, dataset
+
+
+def drop_pixel_data(dataset):
+    # release the raw pixel bytes of a dataset and the pixel array that pydicom caches from them
+    try:
+        del dataset[0x7fe0, 0x0010]
+    except KeyError:
+        pass
+    dataset.__dict__.pop("_pixel_array", None)
+
+
+def prescan(filenames):
+    """
+    Pre-scan the headers of the files, no pixel data is read. Return the list of ManifestEntry.
+    """
+    manifest = []
+    for x in filenames:
+        entry = prescan_file(x)[0]
+        if not entry.accepted:
+            logging.info(r"%s is rejected: %s", x, entry.reason)
+        manifest.append(entry)
+    return manifest
+
+
+def write_manifest(manifest, filename):
+    with open(filename, "w", newline="") as fp:
+        writer = csv.writer(fp)
+        writer.writerow(ManifestEntry._fields)
+        writer.writerows(manifest)
+    logging.info(r"Manifest written: %s", filename)
+##############################################################
+
+
+def is_dicom_file(filename):
+    # a DICOM file has a 128 bytes preamble followed by "DICM", only these 132 bytes are read
+    try:
+        with open(filename, "rb") as fp:
+            return fp.read(132)[128:132] == b"DICM"
+    except OSError:
+        return False
+
+
+def read_dicomdir(filename):
+    """
+    Return the files referenced by the IMAGE records of a DICOMDIR, in the order of the index.
+    """
+    root = os.path.dirname(filename)
+    files = []
+    for record in dicom.read_dicomdir(filename).DirectoryRecordSequence:
+        file_id = getattr(record, "ReferencedFileID", None)
+        if record.DirectoryRecordType != "IMAGE" or not file_id:
+            continue
+        # the file ID is the list of the path components, or a single one
+        if isinstance(file_id, str):
+            file_id = [file_id]
+        files.append(os.path.join(root, *file_id))
+    return files
+
+
+def discover_files(paths, check_preamble=True):
+    """
+    Generator of the dicom files of paths (files or folders).
+    Folders are walked recursively with os.scandir, depth first and sorted by name, the files of a folder
+    before its sub folders. A folder with a DICOMDIR is not walked, the files of its index are given instead.
+    With check_preamble, the files without the DICM marker (images saved by show_image, stray files...)
+    are skipped, only their first 132 bytes are read.
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        folders = [path]
+        while folders:
+            folder = folders.pop()
+            dicomdir = os.path.join(folder, "DICOMDIR")
+            if os.path.isfile(dicomdir):
+                try:
+                    files = read_dicomdir(dicomdir)
+                except Exception as e:
+                    logging.warning(r"%s can not be read, walk the folder: %s", dicomdir, e)
+                else:
+                    logging.debug(r"%s: %s images", dicomdir, len(files))
+                    yield from files
+                    continue
+            try:
+                with os.scandir(folder) as entries:
+                    entries = sorted(entries, key=lambda x: x.name)
+            except OSError as e:
+                logging.warning(r"%s can not be listed: %s", folder, e)
+                continue
+            sub_folders = []
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    sub_folders.append(entry.path)
+                elif entry.is_file() and (not check_preamble or is_dicom_file(entry.path)):
+                    yield entry.path
+            # popped from the end, so reversed to walk them in name order
+            folders.extend(reversed(sub_folders))
+
+
+def group_series(manifest):
+    """
+    Group the accepted files of a manifest (see prescan) by station name and Series Instance UID,
+    for DicomSeries.from_files. The series number alone is not enough, the daily QA reuses it every day.
+    Only the headers are needed, so a whole archive is grouped before any pixel data is read.
+    Return the list of the groups, every group is the list of its file names sorted by instance number.
+    """
+    groups = {}
+    for x in manifest:
+        if x.accepted:
+            groups.setdefault((x.station_name, x.series_instance_uid, x.series), []).append(x)
+    return [[x.file_name for x in sorted(groups[key], key=lambda x: x.instance)] for key in sorted(groups, key=str)]
+##############################################################
+
+
+def file_stat(filename):
+    # size and modification time of a file, as kept in the ProcessedFiles ledger
+    stat = os.stat(filename)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def select_new_files(filenames, writer, check_preamble=True):
+    """
+    Select the files of an incremental run, writer is the SQL3Writer of the run.
+    A file in the ledger with the same size and mtime is skipped without being opened, so the files should be
+    listed by discover_files without check_preamble: the DICM marker is checked here, for the new or changed
+    files only. These are then pre-scanned: the rejected ones are skipped too, and so are the new files whose
+    SOP Instance UID is already stored (e.g. a copy of an analyzed file); they are recorded in the ledger so that
+    the next run does not open them again. A file of the ledger whose size or mtime changed is analyzed again,
+    its record is replaced.
+    Files that failed to be analyzed are not skipped, they are tried again in every run.
+    Return the list of the files to analyze.
+    """
+    processed = writer.processed_files()
+    known = writer.known_instances()
+    selected = []
+    for x in filenames:
+        stat = file_stat(x)
+        if processed.get(x) == stat:
+            continue
+        if check_preamble and not is_dicom_file(x):
+            writer.add_processed(x, stat, None, r"not a dicom file: no DICM marker")
+            continue
+        entry = prescan_file(x)[0]
+        if not entry.accepted:
+            writer.add_processed(x, stat, None, entry.reason)
+        elif x not in processed and entry.sop_instance_uid is not None and entry.sop_instance_uid in known:
+            writer.add_processed(x, stat, entry.sop_instance_uid, r"already stored")
+        else:
+            selected.append(x)
+    logging.info(r"%s of %s files are new or changed", len(selected), len(filenames))
+    return selected
+##############################################################
+
+# compact result of one analyzed file, this is what the worker processes send back instead of the Dicom object.
+# header is the dict of read_header with plain_value values, error is None if the file is analyzed successfully
+# timing is the StageTimer.as_dict of the file, plain lists so that it is sent back cheaply
+# sector_profiles is the (sectors, radius) array of the polar analysis, None if it is not asked for
+AssessmentResult = collections.namedtuple("AssessmentResult",
+                                          ["file_name", "header", "center_row", "center_col", "radius",
+                                           "integration_result", "median_filter_result", "phantom_center_row",
+                                           "phantom_center_col", "phantom_radius_pix", "phantom_radius_mm",
+                                           "sector_profiles", "peak_memory", "timing", "error"],
+                                          defaults=(None,) * 14)
+##############################################################
+
+# Number of geometries (rows, cols, center, radius) whose ring tables are kept in memory.
+# A run normally only sees a handful of them, one per phantom size and center position.
+Ring_Table_Cache_Size = 32
+
+
+@functools.lru_cache(maxsize=Ring_Table_Cache_Size)
+def ring_index_table(rows, cols, center_row, center_col, radius):
+    """
+    Pre-compute the pixels visited by Dicom.bresenham() for every radius from 1 to radius - 1.
+    The pixels are listed in exactly the same order as bresenham visits them, so summing them up
+    with np.bincount gives the same ring sums as the legacy loop.
+    Return (flat_index, ring_label, ring_count):
+    flat_index: position of every visited pixel in the flattened image
+    ring_label: the radius that every visited pixel belongs to
+    ring_count: number of visited pixels of every radius, used to normalise the ring sums
+    The arrays are shared by all images with the same geometry, so they are read only.
+    """
+    row_list = []
+    col_list = []
+    label_list = []
+    for index in range(1, radius):
+        x = 0
+        y = index
+        d = 3 - 2 * index
+        steps = 0
+        while x < y:
+            row_list.extend((center_row - y, center_row + y, center_row - y, center_row + y,
+                             center_row - x, center_row - x, center_row + x, center_row + x))
+            col_list.extend((center_col + x, center_col + x, center_col - x, center_col - x,
+                             center_col + y, center_col - y, center_col + y, center_col - y))
+            steps += 1
+            if d < 0:
+                d = d + 4 * x + 6
+            else:
+                d = d + 4 * (x - y) + 10
+                y -= 1
+            x += 1
+        label_list.extend([index] * (8 * steps))
+    flat_index = np.ravel_multi_index((np.array(row_list, dtype=np.intp), np.array(col_list, dtype=np.intp)),
+                                      (rows, cols))
+    ring_label = np.array(label_list, dtype=np.intp)
+    ring_count = np.bincount(ring_label, minlength=radius)
+    ring_count[0] = 1  # radius 0 has no pixel, avoid dividing by 0
+    for x in (flat_index, ring_label, ring_count):
+        x.setflags(write=False)
+    logging.debug(r"Ring index table built for %s", (rows, cols, center_row, center_col, radius))
+    return flat_index, ring_label, ring_count
+##############################################################
+
+# Number of angles of the polar map (1 degree each) and of the sectors of the per sector profiles.
+# Polar_Angles must be a multiple of Polar_Sectors.
+Polar_Angles = 360
+Polar_Sectors = 8
+
+
+@functools.lru_cache(maxsize=Ring_Table_Cache_Size)
+def polar_table(rows, cols, center_row, center_col, radius, angles=Polar_Angles):
+    """
+    Pre-compute the bilinear interpolation of the polar grid (radius 0 to radius - 1, angles steps of the full turn)
+    of an image of this geometry. Angle 0 points to the right (increasing column), the angles turn counterclockwise
+    as the image is displayed.
+    Return (corner_index, corner_weight), both (4, radius * angles): the flat index of the 4 pixels around every
+    point of the grid in the flattened image and their weight. The arrays are read only, like ring_index_table.
+    """
+    theta = np.arange(angles) * (2 * np.pi / angles)
+    distance = np.arange(radius, dtype=float)[:, np.newaxis]
+    row = (center_row - distance * np.sin(theta)).ravel()
+    col = (center_col + distance * np.cos(theta)).ravel()
+    # the circles of the integration stay in the image, clip anyway against rounding at the border
+    row = np.clip(row, 0, rows - 1)
+    col = np.clip(col, 0, cols - 1)
+    row0 = np.minimum(np.floor(row).astype(np.intp), rows - 2)
+    col0 = np.minimum(np.floor(col).astype(np.intp), cols - 2)
+    dy = row - row0
+    dx = col - col0
+    corner_index = np.stack((row0 * cols + col0, row0 * cols + col0 + 1,
+                             (row0 + 1) * cols + col0, (row0 + 1) * cols + col0 + 1))
+    corner_weight = np.stack(((1 - dy) * (1 - dx), (1 - dy) * dx, dy * (1 - dx), dy * dx))
+    for x in (corner_index, corner_weight):
+        x.setflags(write=False)
+    logging.debug(r"Polar table built for %s", (rows, cols, center_row, center_col, radius, angles))
+    return corner_index, corner_weight
+
+
+def polar_resample(hu_image, center_row, center_col, radius, angles=Polar_Angles):
+    """
+    Resample a 2D image on the polar grid of polar_table with one gather of the 4 corners of every point.
+    Return the (radius, angles) polar map: every row is one circle, every column one direction,
+    so a band on a part of a circle only is a short segment of a row.
+    """
+    rows, cols = hu_image.shape
+    corner_index, corner_weight = polar_table(rows, cols, center_row, center_col, radius, angles)
+    polar_map = (hu_image.ravel()[corner_index] * corner_weight).sum(axis=0)
+    return polar_map.reshape(radius, angles)
+
+
+def sector_profiles(polar_map, sectors=Polar_Sectors):
+    """
+    Mean of the polar map over every sector of the angles: sector k covers the angles from k * 360 / sectors
+    to (k + 1) * 360 / sectors degrees. polar_map can be a single map or a stack of maps.
+    Return the (..., sectors, radius) profiles, one per sector like Integration_Result for the full circle.
+    """
+    radius, angles = polar_map.shape[-2:]
+    if angles % sectors:
+        raise ValueError(r"The angles of the polar map can not be split into sectors: " + str(sectors))
+    profiles = polar_map.reshape(polar_map.shape[:-1] + (sectors, angles // sectors)).mean(axis=-1)
+    return np.swapaxes(profiles, -1, -2)
+##############################################################
+
+
+# result of find_circle. center_row, center_col and radius are the integer circle used by the integration,
+# the radius being standardized to the phantom size; the other fields are the fitted edge of the phantom,
+# with a sub-pixel center and the measured radius in pixels and mm
+PhantomCircle = collections.namedtuple("PhantomCircle",
+                                       ["center_row", "center_col", "radius", "phantom_center_row",
+                                        "phantom_center_col", "phantom_radius_pix", "phantom_radius_mm"],
+                                       defaults=(None, None, None, None))
+
+
+def outer_edges(image, threshold):
+    """
+    First and last crossing of threshold on every row of image, interpolated between the two pixels
+    around the crossing. Holes and structures inside the phantom are never reached.
+    Return (rows, cols) of the crossings.
+    """
+    cols = image.shape[1]
+    above = image > threshold
+    rows = np.nonzero(above.any(axis=1))[0]
+    image = image[rows]
+    first = above[rows].argmax(axis=1)
+    last = cols - 1 - above[rows, ::-1].argmax(axis=1)
+    # the crossing is between first - 1 and first, and between last and last + 1
+    inside = image[np.arange(len(rows)), first]
+    outside = image[np.arange(len(rows)), np.maximum(first - 1, 0)]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        first_col = np.where(first > 0, first - 1 + (threshold - outside) / (inside - outside), -0.5)
+        inside = image[np.arange(len(rows)), last]
+        outside = image[np.arange(len(rows)), np.minimum(last + 1, cols - 1)]
+        last_col = np.where(last < cols - 1, last + (inside - threshold) / (inside - outside), cols - 0.5)
+    return np.concatenate((rows, rows)).astype(float), np.concatenate((first_col, last_col))
+
+
+def fit_circle(rows, cols):
+    """
+    Least squares circle through the points (rows, cols), in closed form (Kasa fit):
+    x^2 + y^2 = a * x + b * y + c is linear in a, b, c.
+    Return (center_row, center_col, radius).
+    """
+    mean_row = rows.mean()
+    mean_col = cols.mean()
+    # fit around the mean of the points to keep the squares small
+    y = rows - mean_row
+    x = cols - mean_col
+    matrix = np.column_stack((y, x, np.ones_like(x)))
+    (a, b, c) = np.linalg.lstsq(matrix, y * y + x * x, rcond=None)[0]
+    return mean_row + a / 2, mean_col + b / 2, np.sqrt(max(c + (a * a + b * b) / 4, 0))
+
+
+def circle_inliers(rows, cols, tolerance=2.0, trials=256):
+    """
+    Find the edge points of the phantom among all the points, the others being e.g. the table.
+    The circles through trials random triples of points are all calculated at once, the one passing
+    within tolerance (pixel) of the most points wins. The random generator is seeded, so the result
+    is the same for the same image. Return the boolean mask of the points on that circle.
+    """
+    sample = np.random.default_rng(0).integers(0, len(rows), (trials, 3))
+    y1, y2, y3 = rows[sample].T
+    x1, x2, x3 = cols[sample].T
+    s1 = x1 * x1 + y1 * y1
+    s2 = x2 * x2 + y2 * y2
+    s3 = x3 * x3 + y3 * y3
+    with np.errstate(invalid="ignore", divide="ignore"):
+        # circumcircle of the triples, the aligned ones give inf / nan and never win
+        d = 2 * (x1 * (y2 - y3) + x2 * (y3 - y1) + x3 * (y1 - y2))
+        center_col = (s1 * (y2 - y3) + s2 * (y3 - y1) + s3 * (y1 - y2)) / d
+        center_row = (s1 * (x3 - x2) + s2 * (x1 - x3) + s3 * (x2 - x1)) / d
+        radius = np.hypot(x1 - center_col, y1 - center_row)
+        # the circles are scored 32 at a time, so the (circle x point) residuals stay small
+        count = np.zeros(trials, dtype=np.intp)
+        for start in range(0, trials, 32):
+            chunk = slice(start, start + 32)
+            residual = np.abs(np.hypot(rows - center_row[chunk, np.newaxis], cols - center_col[chunk, np.newaxis]) -
+                              radius[chunk, np.newaxis])
+            count[chunk] = (residual < tolerance).sum(axis=1)
+    best = np.argmax(count)
+    return np.abs(np.hypot(rows - center_row[best], cols - center_col[best]) - radius[best]) < tolerance
+
+
+def find_circle(hu_image, window_lower, window_upper, pix_space):
+    """
+    Find the phantom center and radius on a windowed HU image, the image is not modified.
+    The phantom is every pixel clearly above the air (window_lower). Its outer edge is found on all the rows
+    and columns at once, the points off the phantom circle (e.g. the table) are dropped, and a circle
+    is fitted to the remaining edge points in closed form.
+    Normally it has 2 kinds of phantom, 20cm and 30cm (diameter), the radius is standardized accordingly.
+    Return a PhantomCircle.
+    """
+    rows, cols = hu_image.shape
+    pix_space = float(pix_space[0])
+    threshold = window_lower + (window_upper - window_lower) / 4
+    edge_rows, edge_cols = outer_edges(hu_image, threshold)
+    edge_cols_t, edge_rows_t = outer_edges(hu_image.T, threshold)
+    edge_rows = np.concatenate((edge_rows, edge_rows_t))
+    edge_cols = np.concatenate((edge_cols, edge_cols_t))
+    fitted = None
+    minimum_points = 16
+    if len(edge_rows) >= minimum_points:
+        keep = circle_inliers(edge_rows, edge_cols)
+        if keep.sum() >= minimum_points:
+            fitted = fit_circle(edge_rows[keep], edge_cols[keep])
+    abnormal = fitted is None
+    if not abnormal:
+        phantom_row, phantom_col, phantom_radius = fitted
+        logging.debug(r"Phantom edge fitted: center %s, %spix (radius), %smm(diameter)<==Calculated phantom diameter",
+                      (phantom_row, phantom_col), phantom_radius, phantom_radius * pix_space * 2)
+        center_row = int(round(phantom_row))
+        center_col = int(round(phantom_col))
+        # the center must be in the image and the phantom bigger than a few pixels
+        abnormal = not (0 <= center_row < rows and 0 <= center_col < cols and phantom_radius > 10)
+    if abnormal:
+        logging.warning(r"Phantom edge is not found, use image center and 50 as radius!")
+        return PhantomCircle(rows // 2, cols // 2, 50)
+    # standardize the radius
+    if phantom_radius * pix_space * 2 < 250:
+        radius = 233
+    else:
+        radius = 220
+    logging.debug(r"%spix, which is: %smm <=========Radius Readjusted", radius, radius * pix_space * 2)
+    # all the circles of the integration must stay in the image
+    largest = min(center_row + 1, rows - center_row, center_col + 1, cols - center_col)
+    if radius > largest:
+        logging.warning(r"Phantom is close to the image border, radius reduced to %s", largest)
+        radius = largest
+    return PhantomCircle(center_row, center_col, radius, float(phantom_row), float(phantom_col),
+                         float(phantom_radius), float(phantom_radius * pix_space))
+##############################################################
+
+
+def median_filter(integration_result):
+    """
+    Low pass the integration result to more visible.
+    integration_result can be a single profile or a stack of profiles (one per row), the filter runs on the
+    last axis so a whole series is filtered at once.
+    """
+    median_result = np.zeros(integration_result.shape)
+    # calculate data by using Median
+    factor = 3
+    # the 1st and 2nd data = factor * md3() - md5()
+    median_result[..., 0] = np.median(integration_result[..., :3], axis=-1) * factor - np.median(
+        integration_result[..., :5], axis=-1)
+    median_result[..., 1] = median_result[..., 0]
+    # the last and 2nd last data = factor * md3() - md5()
+    median_result[..., -1] = np.median(integration_result[..., -3:], axis=-1) * factor - np.median(
+        integration_result[..., -5:], axis=-1)
+    median_result[..., -2] = median_result[..., -1]
+    # every other data is the median of the 6 data around it
+    windows = np.lib.stride_tricks.sliding_window_view(integration_result, 6, axis=-1)
+    median_result[..., 3:-2] = np.median(windows[..., :integration_result.shape[-1] - 5, :], axis=-1)
+    return median_result
+##############################################################
+
+
+def output_name(station_name, kvp, current, kernel, total_col, slice_thick, instance):
+    # base name of the output images of one record
+    return r"{0}_{1}Kv_{2}mA_{3}_{4}I{5}_{6}".format(str(station_name), str(kvp), str(current), str(kernel),
+                                                     str(total_col), str(slice_thick), str(instance))
+
+
+class ProfileFigure:
+    """
+    Reusable Agg figure to save the plots of the profiles (median filter results).
+    pyplot builds a new figure for every plot through its global state, here the figure, the axes and the lines
+    are made once and only the data of the lines is updated, so saving a plot is mostly the image encoding.
+    It does not use the pyplot state, so every process can have its own, see profile_figure.
+    """
+
+    def __init__(self):
+        self.Figure = Figure()
+        self.Canvas = FigureCanvasAgg(self.Figure)
+        self.Axes = self.Figure.add_subplot(111)
+        self.Lines = []
+
+    def save(self, filename, profiles, labels=None):
+        """
+        Plot the profiles, one line each, and save the figure to filename.
+        labels are shown in a legend if given.
+        """
+        # add lines only when there are more profiles than in all the previous plots
+        while len(self.Lines) < len(profiles):
+            self.Lines.append(self.Axes.plot([], [])[0])
+        for index, line in enumerate(self.Lines):
+            if index < len(profiles):
+                line.set_data(np.arange(len(profiles[index])), profiles[index])
+                line.set_label(labels[index] if labels else r"_nolegend_")
+                line.set_visible(True)
+            else:
+                line.set_data([], [])
+                line.set_visible(False)
+        self.Axes.relim(visible_only=True)
+        self.Axes.autoscale_view()
+        legend = self.Axes.get_legend()
+        if legend is not None:
+            legend.remove()
+        if labels:
+            self.Axes.legend(handles=self.Lines[:len(profiles)], fontsize="small")
+        self.Canvas.print_figure(filename)
+# End of class ProfileFigure
+##############################################################
+
+
+@functools.lru_cache(maxsize=None)
+def profile_figure():
+    # the ProfileFigure of this process
+    return ProfileFigure()
+
+
+def rescale_image(hu_image):
+    """
+    Rescale a windowed HU image to 0~255 for display. It is only needed to save the image,
+    so it is calculated when the image is saved and dropped right after.
+    """
+    image = hu_image - hu_image.min()  # get rid of minus number
+    image *= 255
+    image /= image.max()  # rescale the image to fit 0~255
+    return image
+
+
+def save_images(file_name, header, image_rescale, center_row, center_col, radius, median_result):
+    """
+    Save the image with the integration circle drawn on it and the figure of the median filter result.
+    header is the dict returned by read_header, it gives the output file names.
+    """
+    # set up the output file name
+    try:
+        image__filename = output_name(header["Dicom_Station_Name"], header["Dicom_KVP"], header["Dicom_Current"],
+                                      header["Dicom_Kernel"], header["Dicom_Total_Collimation"],
+                                      header["Dicom_Slice_Thickness"], header["Dicom_Instance"])
+        im = Image.fromarray(image_rescale).convert("L")
+    except Exception as e:
+        logging.error(str(e))
+        return
+    # prepare to drawing the image
+    draw_surface = ImageDraw.Draw(im)
+    point = radius
+    # draw the radius circle
+    bounding_box = (center_col - point, center_row - point,
+                    center_col + point, center_row + point)
+    draw_surface.ellipse(bounding_box)
+    # save image
+    try:
+        im.save(file_name + image__filename + r".jpeg", "png")
+    except Exception as e:
+        logging.error(str(e))
+        return
+    # prepare the draw the fig
+    try:
+        profile_figure().save(file_name + image__filename + r"_fig.jpeg", [median_result])
+    except Exception as e:
+        logging.error(str(e))
+        return
+
+
+def save_polar_images(file_name, header, polar_map, sector_result):
+    """
+    Save the polar map as an image (one row per radius, one column per degree) and the figure
+    of the median filter result of every sector, named after the images of save_images.
+    """
+    try:
+        image__filename = output_name(header["Dicom_Station_Name"], header["Dicom_KVP"], header["Dicom_Current"],
+                                      header["Dicom_Kernel"], header["Dicom_Total_Collimation"],
+                                      header["Dicom_Slice_Thickness"], header["Dicom_Instance"])
+        Image.fromarray(rescale_image(polar_map)).convert("L").save(file_name + image__filename + r"_polar.jpeg",
+                                                                    "png")
+        step = 360 // len(sector_result)
+        labels = [r"{0}-{1}deg".format(x * step, (x + 1) * step) for x in range(len(sector_result))]
+        profile_figure().save(file_name + image__filename + r"_sectors.jpeg", list(sector_result), labels)
+    except Exception as e:
+        logging.error(str(e))
+        return
+
+
+def render_profiles(table, output_path="", overlay=True):
+    """
+    Deferred rendering: save the figure of the median filter result of every record of a ProfileTable
+    (see SQL3Handler.query) from the stored profiles, no dicom file is read again.
+    The figures are named after the record and its uid, so the records of the same protocol and instance number
+    (e.g. the daily QA) do not overwrite each other.
+    With overlay, one more figure per scanner shows all its profiles together.
+    The image of the phantom with the integration circle needs the pixel data, it is only saved inline.
+    Return the number of figures saved.
+    """
+    if len(table) == 0:
+        return 0
+    metadata = table.Metadata
+    lengths = (~np.isnan(table.Profiles)).sum(axis=1)
+    # the profiles of the same length are filtered at once
+    median_results = [None] * len(table)
+    for length in np.unique(lengths):
+        index = np.nonzero(lengths == length)[0]
+        for x, result in zip(index, median_filter(table.Profiles[index, :length])):
+            median_results[x] = result
+    figure = profile_figure()
+    count = 0
+    for x, record in enumerate(metadata):
+        filename = output_path + output_name(record.serial_number, record.tube_voltage, record.tube_current,
+                                             record.kernel, record.total_collimation, record.slice_thickness,
+                                             record.instance) + r"_" + str(record.uid) + r"_fig.jpeg"
+        try:
+            figure.save(filename, [median_results[x]])
+        except Exception as e:
+            logging.error(r"%s: %s", filename, e)
+            continue
+        count += 1
+    if overlay:
+        keys, inverse = table.groups("serial_number")
+        for group, key in enumerate(keys):
+            index = np.nonzero(inverse == group)[0]
+            labels = [str(metadata.tube_voltage[x]) + r"Kv_" + str(metadata.kernel[x]) + r"_" +
+                      str(metadata.instance[x]) for x in index]
+            filename = output_path + str(key) + r"_overlay.jpeg"
+            try:
+                # too many lines make the legend unreadable
+                figure.save(filename, [median_results[x] for x in index], labels if len(index) <= 10 else None)
+            except Exception as e:
+                logging.error(r"%s: %s", filename, e)
+                continue
+            count += 1
+    logging.info(r"%s figures rendered", count)
+    return count
+##############################################################
+
 
 class Dicom:
     """
@@ -130,81 +1639,103 @@ class Dicom:
     Function description:
     __imi__: to initialize Dicom file and call other functions to calculate circular integration
     calc_circle: to find the phantom center and find the radius. Normally it has 2 kinds of phantom,
-                 20cm and 30cm (diameter)
-    bresenham: draw a circle on the image with a radius. return the sum of the points that on the edge of the circle
+                 20cm and 30cm (diameter). The fitted edge of the phantom is kept in Phantom_Center_Row/Col
+                 (sub-pixel), Phantom_Radius_Pix and Phantom_Radius_mm
+    bresenham: draw a circle on the image with a radius. add the points that on the edge of the circle to the
+               integration result and return the number of points
     integration: this function do 2 parts:
-        part 1: call bresenham with different radius (from 1 to phantom radius). And then calculate the
-                integration. The integration must be weighted average number because when radius is bigger,
-                the number of points is bigger
+        part 1: calculate the integration of every radius (from 1 to phantom radius). The integration must be
+                weighted average number because when radius is bigger, the number of points is bigger.
+                "vectorized" method gathers all circles in one pass with the cached ring_index_table,
+                "bresenham" method is the legacy loop calling bresenham once per radius, kept to check parity.
         part 2: low pass the integration result to more visible.
+    polar_analysis: with polar, resample the image on a (radius x angle) grid with the cached polar_table.
+                    Polar_Map is the (radius, angles) map, Sector_Profiles the (sectors, radius) profiles
+                    of the sectors of the circle, to locate the bands on a part of the circle only
+    show_image: save the image and the figure, the image is rescaled to 0~255 only here
+    release_pixels: drop the pixel buffers once the profile is calculated
+    Timer is the StageTimer of the file, pass timer to add the stages to an existing one.
+    With low_memory, the HU image is float32 and the raw pixels are released as soon as it is calculated,
+    so only one image buffer is kept (float64 HU image plus the raw pixels otherwise).
     """
+    Integration_Methods = ("vectorized", "bresenham")
 
-    def __init__(self, filename, center=0, width=100):
+    def __init__(self, filename, center=0, width=100, integration_method="vectorized", lazy=True, low_memory=False,
+                 dataset=None, timer=None, polar=False):
+        if integration_method not in self.Integration_Methods:
+            raise ValueError(r"Unknown integration method: " + str(integration_method))
+        self.Integration_Method = integration_method
+        self.Low_Memory = low_memory
+        self.Timer = StageTimer() if timer is None else timer
+        self.Polar = polar
+        self.Polar_Map = None
+        self.Sector_Profiles = None
+        self.Sector_Median_Result = None
+        # reason of the pre-scan if the file is not a Band Assessment image (see read_dicom)
+        self.Rejected_Reason = None
         # set up some basic date
         self.isShowImgReady = False
         self.Center_Col = 256
         self.Center_Row = 256
         self.Radius = 200
         self.Dicom_File_Name = filename
-        # open the dicom file
-        logging.info(r"Opening file:" + filename)
-        try:
-            self.Dicom_File = dicom.read_file(filename)
-        except Exception as e:
-            logging.error(str(e))
-            return
+        # open the dicom file, unless it is already read (see iter_assessments)
+        if dataset is not None:
+            self.Dicom_File = dataset
+        elif lazy:
+            logging.info(r"Opening file:%s", filename)
+            # read the header only, the pixel data is read only if the file is accepted
+            entry, self.Dicom_File = read_dicom(filename, self.Timer)
+            if self.Dicom_File is None:
+                self.Rejected_Reason = entry.reason
+                logging.error(r"%s is rejected: %s", self.Dicom_File_Name, entry.reason)
+                return
+        else:
+            logging.info(r"Opening file:%s", filename)
+            try:
+                with self.Timer.stage("read"):
+                    self.Dicom_File = dicom.read_file(filename)
+            except Exception as e:
+                logging.error(str(e))
+                return
         # if file is opened, continue to extract data from dicom file
         try:
             self.Dicom_Station_Name = self.Dicom_File[0x0018, 0x1000].value
-            logging.debug(str(self.Dicom_Station_Name) + r"<==System Serial No")
+            logging.debug(r"%s<==System Serial No", self.Dicom_Station_Name)
             self.StudyDescription = self.Dicom_File[0x0008, 0x1030].value
             if self.StudyDescription != r"Band Assessment":
-                logging.error(self.Dicom_File_Name + " is not Band Assessment")
+                logging.error(r"%s is not Band Assessment", self.Dicom_File_Name)
                 return
-            logging.debug(self.Dicom_File_Name + ":" + self.StudyDescription + r"<==Study Description is:")
-            self.Slop = self.Dicom_File[0x0028, 0x1053].value
-            self.Intercept = self.Dicom_File[0x0028, 0x1052].value
-            self.Dicom_Image_Data = np.array(self.Dicom_File.pixel_array)
-            self.Dicom_Rows = self.Dicom_File[0x0028, 0x0010].value
-            self.Dicom_Cols = self.Dicom_File[0x0028, 0x0011].value
-            self.Dicom_Pix_Space = self.Dicom_File[0x0028, 0x0030].value
-            self.Dicom_KVP = self.Dicom_File[0x0018, 0x0060].value
-            self.Dicom_Current = self.Dicom_File[0x0018, 0x1151].value
-            self.Dicom_Kernel = self.Dicom_File[0x0018, 0x1210].value
-            self.Dicom_Series = self.Dicom_File[0x0020, 0x0011].value
-            self.Dicom_Total_Collimation = self.Dicom_File[0x0018, 0x9307].value
-            self.Dicom_Slice_Thickness = self.Dicom_File[0x0018, 0x0050].value
-            self.Dicom_Instance = self.Dicom_File[0x0020, 0x0013].value
+            logging.debug(r"%s:%s<==Study Description is:", self.Dicom_File_Name, self.StudyDescription)
+            self.Header = read_header(self.Dicom_File)
+            for name, value in self.Header.items():
+                setattr(self, name, value)
+            with self.Timer.stage("decode"):
+                self.Dicom_Image_Data = self.Dicom_File.pixel_array
             # self.Dicom_Image_No = int(self.Dicom_Total_Collimation / self.Dicom_Slice_Thickness)
-            logging.debug(r"Image Mode: " +
-                          str(self.Dicom_KVP) + r"KV_" +
-                          str(self.Dicom_Current) + r"mA_" +
-                          str(self.Dicom_Kernel) + r"_" +
-                          str(self.Dicom_Total_Collimation) + r"I" +
-                          str(self.Dicom_Slice_Thickness) + r"." +
-                          str(self.Dicom_Instance))
-            self.Dicom_Pix_Space = self.Dicom_File[0x0028, 0x0030].value
+            logging.debug(r"Image Mode: %sKV_%smA_%s_%sI%s.%s", self.Dicom_KVP, self.Dicom_Current, self.Dicom_Kernel,
+                          self.Dicom_Total_Collimation, self.Dicom_Slice_Thickness, self.Dicom_Instance)
         except Exception as e:
             logging.error(e)
             return
         # Do the initial calculation
-        self.Dicom_HU_Image = self.Dicom_Image_Data * self.Slop + self.Intercept  # Convert to HU unit
-        self.Window_Upper = center + width / 2
-        self.Window_Lower = center - width / 2
-        # make filter according to center and width
-        upper_filter = self.Dicom_HU_Image > self.Window_Upper
-        self.Dicom_HU_Image[upper_filter] = self.Window_Upper  # set upper value
-        lower_filter = self.Dicom_HU_Image < self.Window_Lower
-        self.Dicom_HU_Image[lower_filter] = self.Window_Lower  # set lower value
-        # rescale the data to 0~255
-        min_hu_image = self.Dicom_HU_Image.min()
-        self.Image_rescale = self.Dicom_HU_Image + (0 - min_hu_image)  # get rid of minus number
-        max_image_rescale = self.Image_rescale.max()
-        self.Image_rescale = self.Image_rescale * 255 / max_image_rescale  # rescale the image to fit 0~255
-        # make a copy of HU image for calculate center of the circle
-        self.Dicom_HU_Copy = self.Dicom_HU_Image.copy()
+        with self.Timer.stage("hu_window"):
+            if self.Low_Memory:
+                # Convert to HU unit in place in one float32 buffer, then the raw pixels are not needed any more
+                self.Dicom_HU_Image = self.Dicom_Image_Data.astype(np.float32)
+                self.Dicom_HU_Image *= np.float32(self.Slop)
+                self.Dicom_HU_Image += np.float32(self.Intercept)
+                self.Dicom_Image_Data = None
+                drop_pixel_data(self.Dicom_File)
+            else:
+                self.Dicom_HU_Image = self.Dicom_Image_Data * self.Slop + self.Intercept  # Convert to HU unit
+            self.Window_Upper = center + width / 2
+            self.Window_Lower = center - width / 2
+            # set upper and lower value according to center and width
+            np.clip(self.Dicom_HU_Image, self.Window_Lower, self.Window_Upper, out=self.Dicom_HU_Image)
         # try to calculate radius and center col / row
-        self.calc_circle()
+        with self.Timer.stage("center"):
+            self.calc_circle()
         logging.debug(r"Center of circle has been found.")
         # define circular integration result
         self.Integration_Result = np.zeros(self.Radius)
@@ -212,81 +1743,23 @@ class Dicom:
         # main calculation
         self.integration()
         logging.debug(r"Circular integration done.")
+        if self.Polar:
+            self.polar_analysis()
+            logging.debug(r"Polar analysis done.")
         self.isShowImgReady = True
     ###############################################
 
     def calc_circle(self):
-        # remove the pixel if the pixel is low
-        remove_rate = 1.2  # define rate
-        remove_low_value = self.Dicom_HU_Copy < self.Window_Upper / remove_rate  # set up the filter
-        self.Dicom_HU_Copy[remove_low_value] = 0  # remove the low values
-        # convert the np array to image, then use PIL to find image edge
-        im = Image.fromarray(self.Dicom_HU_Copy).convert("L").filter(ImageFilter.FIND_EDGES)
-        # convert image back to np array
-        filtered_image = np.array(im)
-        # use filtered image to re-calculate center and radius
-        # the method is simple
-        # from up/down/left/right side to go into center
-        # the 1st number is > mean value, it's the edge
-        # calculate the distance from th edge to center
-        # start to calculate center col
-        abnormal = False  # set up the flag to store if calculation is abnormal
-        left_distance = 0
-        right_distance = 0
-        up_distance = 0
-        low_distance = 0
-        for left_distance in range(1, im.size[1]):
-            if filtered_image[self.Center_Row, left_distance] != 0:
-                break
-        for right_distance in range(1, im.size[1]):
-            if filtered_image[self.Center_Row, im.size[1] - right_distance] != 0:
-                break
-        self.Center_Col += (left_distance - right_distance) // 2
-        logging.debug(r"Center Col calculated as: " + str(self.Center_Col))
-        # if the calculated center col deviated too much
-        deviation = 20
-        if (self.Center_Col > self.Dicom_Cols // 2 + deviation) or (self.Center_Col < self.Dicom_Cols // 2 - deviation):
-            logging.warning(r"It seems abnormal when calculate Center Col, use image center now!")
-            self.Center_Col = self.Dicom_Cols // 2
-            abnormal = True
-        # start to calculate center row
-        for up_distance in range(1, im.size[0]):
-            if filtered_image[up_distance, self.Center_Col] != 0:
-                break
-        for low_distance in range(1, im.size[1]):
-            if filtered_image[im.size[1] - low_distance, self.Center_Col] != 0:
-                break
-        self.Center_Row += (up_distance - low_distance) // 2
-        logging.debug(r"Center Row calculated as: " + str(self.Center_Row))
-        # if the calculated center row deviated too much
-        if (self.Center_Row > self.Dicom_Rows // 2 + deviation) or (self.Center_Row < self.Dicom_Rows // 2 - deviation):
-            logging.warning(r"It seems abnormal when calculate Center row, use image center now!")
-            self.Center_Row = self.Dicom_Rows // 2
-            abnormal = True
-        # set different radius according to normal/abnormal situation
-        if abnormal is False:
-            self.Radius = (im.size[0] - left_distance - right_distance) // 2
-            diameter_in_cm = self.Radius * self.Dicom_Pix_Space[0] * 2
-            logging.debug(str(self.Radius) + r"pix (radius), " + str(diameter_in_cm) +
-                          r"cm(diameter)<==Calculated phantom diameter")
-            # standardize the radius
-            if diameter_in_cm < 250:
-                self.Radius = 233
-                logging.debug(str(self.Radius) + r"pix" + r", which is: " +
-                              str(self.Radius * self.Dicom_Pix_Space[0] * 2) + r"cm <=========Radius Readjusted")
-            else:
-                self.Radius = 220
-                logging.debug(str(self.Radius) + r"pix" + r", which is: " +
-                              str(self.Radius * self.Dicom_Pix_Space[0] * 2) + r"cm <=========Radius Readjusted")
-        else:
-            logging.warning(r"Calculated center is abnormal, use 50 as radius!")
-            self.Radius = 50
+        circle = find_circle(self.Dicom_HU_Image, self.Window_Lower, self.Window_Upper, self.Dicom_Pix_Space)
+        self.Center_Row, self.Center_Col, self.Radius = circle[:3]
+        self.Phantom_Center_Row, self.Phantom_Center_Col, self.Phantom_Radius_Pix, self.Phantom_Radius_mm = circle[3:]
     #######################################
 
     def bresenham(self, radius):
         x = 0
         y = radius
         d = 3 - 2 * radius
+        points = 0
         while x < y:
             self.Integration_Result[radius] = self.Integration_Result[radius] + self.Dicom_HU_Image[
                 self.Center_Row - y, self.Center_Col + x]
@@ -304,137 +1777,555 @@ class Dicom:
                 self.Center_Row + x, self.Center_Col + y]
             self.Integration_Result[radius] = self.Integration_Result[radius] + self.Dicom_HU_Image[
                 self.Center_Row + x, self.Center_Col - y]
+            points += 8
             if d < 0:
                 d = d + 4 * x + 6
             else:
                 d = d + 4 * (x - y) + 10
                 y -= 1
             x += 1
+        return points
     ###################################################
 
     def integration(self):
-        for index in range(1, len(self.Integration_Result)):
-            self.bresenham(index)
-            self.Integration_Result[index] /= (index * 2 * 3.14)
-        # calculate data by using Median
-        factor = 3
-        # the 1st and 2nd data = factor * md3() - md5()
-        self.Median_Filter_Result[0] = np.median(self.Integration_Result[:3]) * factor - np.median(
-            self.Integration_Result[:5])
-        self.Median_Filter_Result[1] = np.median(self.Integration_Result[:3]) * factor - np.median(
-            self.Integration_Result[:5])
-        # the last and 2nd last data = factor * md3() - md5()
-        self.Median_Filter_Result[-1] = np.median(self.Integration_Result[-3:]) * factor - np.median(
-            self.Integration_Result[-5:])
-        self.Median_Filter_Result[-2] = np.median(self.Integration_Result[-3:]) * factor - np.median(
-            self.Integration_Result[-5:])
-        for index in range(3, len(self.Integration_Result) - 2):
-            self.Median_Filter_Result[index] = np.median(self.Integration_Result[index - 3:index + 3])
+        with self.Timer.stage("integration"):
+            if self.Integration_Method == "bresenham":
+                for index in range(1, len(self.Integration_Result)):
+                    points = self.bresenham(index)
+                    self.Integration_Result[index] /= points
+            else:
+                rows, cols = self.Dicom_HU_Image.shape
+                flat_index, ring_label, ring_count = ring_index_table(rows, cols, self.Center_Row, self.Center_Col,
+                                                                      self.Radius)
+                ring_sum = np.bincount(ring_label, weights=self.Dicom_HU_Image.ravel()[flat_index],
+                                       minlength=self.Radius)
+                self.Integration_Result = ring_sum / ring_count
+        with self.Timer.stage("median_filter"):
+            self.Median_Filter_Result = median_filter(self.Integration_Result)
+    ######################################################
+
+    def polar_analysis(self):
+        with self.Timer.stage("polar"):
+            self.Polar_Map = polar_resample(self.Dicom_HU_Image, self.Center_Row, self.Center_Col, self.Radius)
+            self.Sector_Profiles = sector_profiles(self.Polar_Map)
+            self.Sector_Median_Result = median_filter(self.Sector_Profiles)
     ######################################################
 
     def show_image(self):
-        if self.isShowImgReady:
-            # set up the output file name
-            try:
-                image__filename = r"{0}_{1}Kv_{2}mA_{3}_{4}I{5}_{6}.jpeg".format(str(self.Dicom_Station_Name),
-                                                                                 str(self.Dicom_KVP),
-                                                                                 str(self.Dicom_Current),
-                                                                                 str(self.Dicom_Kernel),
-                                                                                 str(self.Dicom_Total_Collimation),
-                                                                                 str(self.Dicom_Slice_Thickness),
-                                                                                 str(self.Dicom_Instance))
-                image__filename__fig = r"{0}_{1}Kv_{2}mA_{3}_{4}I{5}_{6}_fig.jpeg".format(
-                    str(self.Dicom_Station_Name),
-                    str(self.Dicom_KVP),
-                    str(self.Dicom_Current),
-                    str(self.Dicom_Kernel),
-                    str(self.Dicom_Total_Collimation),
-                    str(self.Dicom_Slice_Thickness),
-                    str(self.Dicom_Instance))
-                im = Image.fromarray(self.Image_rescale).convert("L")
-            except Exception as e:
-                logging.error(str(e))
-                return
-            # prepare to drawing the image
-            draw_surface = ImageDraw.Draw(im)
-            point = self.Radius
-            # draw the radius circle
-            bounding_box = (self.Center_Col - point, self.Center_Row - point,
-                            self.Center_Col + point, self.Center_Row + point)
-            draw_surface.ellipse(bounding_box)
-            # save image
-            try:
-                im.save(self.Dicom_File_Name + image__filename, "png")
-            except Exception as e:
-                logging.error(str(e))
-                return
-            # prepare the draw the fig
-            try:
-                plt.plot(self.Median_Filter_Result)
-                plt.savefig(self.Dicom_File_Name + image__filename__fig)
-            except Exception as e:
-                logging.error(str(e))
-                return
-            finally:
-                plt.close()
+        if self.isShowImgReady and self.Dicom_HU_Image is not None:
+            with self.Timer.stage("render"):
+                save_images(self.Dicom_File_Name, self.Header, rescale_image(self.Dicom_HU_Image), self.Center_Row,
+                            self.Center_Col, self.Radius, self.Median_Filter_Result)
+                if self.Polar_Map is not None:
+                    save_polar_images(self.Dicom_File_Name, self.Header, self.Polar_Map, self.Sector_Median_Result)
         else:  # if self.isShowImgReady == False
-            logging.warning(r"File is not complete initialized, skip show image.")
+            logging.warning(r"File is not complete initialized or pixels are released, skip show image.")
             return
     ######################################################
 
-    def connect_database(self):
+    def release_pixels(self):
+        # the profile is kept, the image can not be shown any more
+        self.Dicom_Image_Data = None
+        self.Dicom_HU_Image = None
+        if getattr(self, "Dicom_File", None) is not None:
+            drop_pixel_data(self.Dicom_File)
+    ######################################################
+
+    def connect_database(self, writer=None):
+        # store with the SQL3Writer of the run if given, otherwise open the database just for this record
         if self.isShowImgReady:
-            database = SQL3Handler(self.Dicom_Station_Name,
-                                   self.Dicom_KVP,
-                                   self.Dicom_Current,
-                                   self.Dicom_Kernel,
-                                   self.Dicom_Total_Collimation,
-                                   self.Dicom_Slice_Thickness,
-                                   self.Dicom_Instance,
-                                   self.Integration_Result)
-            database.insert_data()
+            row = (self.Dicom_Station_Name,
+                   self.Dicom_KVP,
+                   self.Dicom_Current,
+                   self.Dicom_Kernel,
+                   self.Dicom_Total_Collimation,
+                   self.Dicom_Slice_Thickness,
+                   self.Dicom_Instance,
+                   self.Integration_Result,
+                   self.Dicom_Study_Date,
+                   self.Dicom_SOP_Instance_UID)
+            if writer is None:
+                SQL3Handler(*row, phantom_radius_pix=self.Phantom_Radius_Pix,
+                            phantom_radius_mm=self.Phantom_Radius_mm).insert_data()
+            else:
+                writer.add_row(*row, timing=self.Timer.as_dict(), phantom_radius_pix=self.Phantom_Radius_Pix,
+                               phantom_radius_mm=self.Phantom_Radius_mm)
         else:
             logging.warning(r"File is not completely initialized, skip storing in database")
             return
     # End of connect_database
     ##################################################
 
+    def to_result(self):
+        if self.isShowImgReady:
+            header = dict((name, plain_value(value)) for name, value in self.Header.items())
+            return AssessmentResult(self.Dicom_File_Name, header, self.Center_Row, self.Center_Col, self.Radius,
+                                    self.Integration_Result, self.Median_Filter_Result, self.Phantom_Center_Row,
+                                    self.Phantom_Center_Col, self.Phantom_Radius_Pix, self.Phantom_Radius_mm,
+                                    self.Sector_Profiles, timing=self.Timer.as_dict())
+        elif self.Rejected_Reason is not None:
+            return AssessmentResult(self.Dicom_File_Name, timing=self.Timer.as_dict(),
+                                    error=r"rejected: " + self.Rejected_Reason)
+        else:
+            return AssessmentResult(self.Dicom_File_Name, timing=self.Timer.as_dict(),
+                                    error=r"File is not completely initialized")
+    ##################################################
+
 # End of class dicom
 #######################################################################
 
 
+# largest difference (pixel) of the fitted center of a slice from the one of its series, see DicomSeries
+Series_Center_Tolerance = 1
+
+
+class DicomSeries:
+    """
+    This class deals with all the images of one Band Assessment series at once.
+    Every instance of a series shares geometry, kernel and collimation, so the pixel arrays are stacked
+    into one (N, rows, cols) volume and the calculation is done for all N slices in single broadcast operations.
+    Function description:
+    from_files: open a list of files and group the Band Assessment ones by station name and Series Instance UID
+    __init__: stack the slices of one series, convert to HU unit, window them and call integration.
+              The circle is fitted on every slice, the slices whose circle is off the one of most slices by more
+              than Series_Center_Tolerance pixel (e.g. a phantom placed again) are left out in Other_Slices,
+              from_files calculates them in their own series
+    integration: calculate the circular integration of all slices with one np.bincount and low pass them.
+                 The slices share one circle, fitted on their mean slice.
+    polar_analysis: same as Dicom, one gather per slice with the polar_table shared by the whole series,
+                    Polar_Map is (N, radius, angles) and Sector_Profiles (N, sectors, radius)
+    show_image / connect_database: same as Dicom, done for every slice
+    Timer is the StageTimer of the series, every slice is stored with its share of it (see connect_database).
+    """
+
+    def __init__(self, datasets, filenames, center=0, width=100, timer=None, polar=False):
+        datasets = list(datasets)
+        self.isShowImgReady = False
+        self.Timer = StageTimer() if timer is None else timer
+        self.Polar_Map = None
+        self.Sector_Profiles = None
+        self.Sector_Median_Result = None
+        self.Dicom_File_Names = list(filenames)
+        self.Headers = [read_header(x) for x in datasets]
+        self.Dicom_Station_Name = self.Headers[0]["Dicom_Station_Name"]
+        self.Dicom_Series = self.Headers[0]["Dicom_Series"]
+        self.Dicom_Pix_Space = self.Headers[0]["Dicom_Pix_Space"]
+        logging.debug(r"%s_%s: stack %s slices", self.Dicom_Station_Name, self.Dicom_Series, len(self.Headers))
+        with self.Timer.stage("decode"):
+            self.Dicom_Image_Data = np.stack([x.pixel_array for x in datasets])
+        with self.Timer.stage("hu_window"):
+            # Convert to HU unit, slop and intercept are broadcast over the slices
+            slop = np.array([x["Slop"] for x in self.Headers], dtype=float).reshape(-1, 1, 1)
+            intercept = np.array([x["Intercept"] for x in self.Headers], dtype=float).reshape(-1, 1, 1)
+            self.Dicom_HU_Image = self.Dicom_Image_Data * slop + intercept
+            self.Window_Upper = center + width / 2
+            self.Window_Lower = center - width / 2
+            np.clip(self.Dicom_HU_Image, self.Window_Lower, self.Window_Upper, out=self.Dicom_HU_Image)
+        # try to calculate radius and center col / row, on every slice first
+        with self.Timer.stage("center"):
+            circles = [find_circle(x, self.Window_Lower, self.Window_Upper, self.Dicom_Pix_Space)[:3]
+                       for x in self.Dicom_HU_Image]
+        reference = collections.Counter(circles).most_common(1)[0][0]
+        keep = [abs(x[0] - reference[0]) <= Series_Center_Tolerance and
+                abs(x[1] - reference[1]) <= Series_Center_Tolerance and x[2] == reference[2] for x in circles]
+        self.Other_Slices = [(datasets[x], self.Dicom_File_Names[x]) for x in range(len(keep)) if not keep[x]]
+        if self.Other_Slices:
+            logging.warning(r"%s_%s: %s slices do not share the phantom circle, they are calculated apart",
+                            self.Dicom_Station_Name, self.Dicom_Series, len(self.Other_Slices))
+            index = np.nonzero(keep)[0]
+            self.Dicom_File_Names = [self.Dicom_File_Names[x] for x in index]
+            self.Headers = [self.Headers[x] for x in index]
+            self.Dicom_Image_Data = self.Dicom_Image_Data[index]
+            self.Dicom_HU_Image = self.Dicom_HU_Image[index]
+        with self.Timer.stage("center"):
+            circle = find_circle(self.Dicom_HU_Image.mean(axis=0), self.Window_Lower, self.Window_Upper,
+                                 self.Dicom_Pix_Space)
+        self.Center_Row, self.Center_Col, self.Radius = circle[:3]
+        self.Phantom_Center_Row, self.Phantom_Center_Col, self.Phantom_Radius_Pix, self.Phantom_Radius_mm = circle[3:]
+        logging.debug(r"Center of circle has been found.")
+        self.integration()
+        logging.debug(r"Circular integration done.")
+        if polar:
+            self.polar_analysis()
+            logging.debug(r"Polar analysis done.")
+        self.isShowImgReady = True
+    ###############################################
+
+    @classmethod
+    def from_files(cls, filenames, center=0, width=100, timer=None, polar=False):
+        """
+        Open the files and group the Band Assessment images by station name and Series Instance UID (the series
+        number is reused by every daily QA). Images of a series with a different size are put in their own group,
+        so they can still be stacked, and so are the slices that do not share the circle of their series.
+        Return a list of DicomSeries, slices are sorted by instance number.
+        Every series has its own Timer, with the reading of its files. The reading of the rejected files and
+        the time of the series that fail are added to timer if given, polar is passed to every series.
+        """
+        timer = StageTimer() if timer is None else timer
+        groups = {}
+        for filename in filenames:
+            logging.info(r"Opening file:%s", filename)
+            # the pixel data is read only if the header is accepted
+            file_timer = StageTimer()
+            entry, dataset = read_dicom(filename, file_timer)
+            if dataset is None:
+                timer.add(file_timer)
+                logging.error(r"%s is rejected: %s", filename, entry.reason)
+                continue
+            header = read_header(dataset)
+            key = (header["Dicom_Station_Name"], header["Dicom_Series_Instance_UID"], header["Dicom_Series"],
+                   header["Dicom_Rows"], header["Dicom_Cols"])
+            groups.setdefault(key, []).append((header["Dicom_Instance"], filename, dataset, file_timer))
+        series_list = []
+        for key in sorted(groups, key=str):
+            group = sorted(groups[key], key=lambda x: x[0])
+            series_timer = StageTimer()
+            for x in group:
+                series_timer.add(x[3])
+            pending = [([x[2] for x in group], [x[1] for x in group], series_timer)]
+            while pending:
+                datasets, names, series_timer = pending.pop()
+                try:
+                    series = cls(datasets, names, center=center, width=width, timer=series_timer, polar=polar)
+                except Exception as e:
+                    timer.add(series_timer)
+                    logging.error(r"%s: %s", key, e)
+                    break
+                series_list.append(series)
+                if series.Other_Slices:
+                    pending.append(([x[0] for x in series.Other_Slices], [x[1] for x in series.Other_Slices],
+                                    StageTimer()))
+                    series.Other_Slices = []
+        return series_list
+    ###############################################
+
+    def integration(self):
+        number = len(self.Headers)
+        rows, cols = self.Dicom_HU_Image.shape[1:]
+        with self.Timer.stage("integration"):
+            flat_index, ring_label, ring_count = ring_index_table(rows, cols, self.Center_Row, self.Center_Col,
+                                                                  self.Radius)
+            # give every slice its own range of labels, then one bincount sums the rings of all the slices
+            slice_label = ring_label + (np.arange(number) * self.Radius)[:, np.newaxis]
+            ring_sum = np.bincount(slice_label.ravel(),
+                                   weights=self.Dicom_HU_Image.reshape(number, -1)[:, flat_index].ravel(),
+                                   minlength=number * self.Radius)
+            self.Integration_Result = ring_sum.reshape(number, self.Radius) / ring_count
+        with self.Timer.stage("median_filter"):
+            self.Median_Filter_Result = median_filter(self.Integration_Result)
+    ######################################################
+
+    def polar_analysis(self):
+        with self.Timer.stage("polar"):
+            self.Polar_Map = np.stack([polar_resample(x, self.Center_Row, self.Center_Col, self.Radius)
+                                       for x in self.Dicom_HU_Image])
+            self.Sector_Profiles = sector_profiles(self.Polar_Map)
+            self.Sector_Median_Result = median_filter(self.Sector_Profiles)
+    ######################################################
+
+    def show_image(self):
+        if self.isShowImgReady:
+            for index, header in enumerate(self.Headers):
+                with self.Timer.stage("render"):
+                    save_images(self.Dicom_File_Names[index], header, rescale_image(self.Dicom_HU_Image[index]),
+                                self.Center_Row, self.Center_Col, self.Radius, self.Median_Filter_Result[index])
+                    if self.Polar_Map is not None:
+                        save_polar_images(self.Dicom_File_Names[index], header, self.Polar_Map[index],
+                                          self.Sector_Median_Result[index])
+        else:
+            logging.warning(r"Series is not complete initialized, skip show image.")
+            return
+    ######################################################
+
+    def connect_database(self, writer=None):
+        if self.isShowImgReady:
+            # every slice is stored with an equal share of the time of the series
+            timing = self.Timer.share(len(self.Headers))
+            for index, header in enumerate(self.Headers):
+                row = (header["Dicom_Station_Name"],
+                       header["Dicom_KVP"],
+                       header["Dicom_Current"],
+                       header["Dicom_Kernel"],
+                       header["Dicom_Total_Collimation"],
+                       header["Dicom_Slice_Thickness"],
+                       header["Dicom_Instance"],
+                       self.Integration_Result[index],
+                       header["Dicom_Study_Date"],
+                       header["Dicom_SOP_Instance_UID"])
+                if writer is None:
+                    SQL3Handler(*row, timing=timing, phantom_radius_pix=self.Phantom_Radius_Pix,
+                                phantom_radius_mm=self.Phantom_Radius_mm).insert_data()
+                else:
+                    writer.add_row(*row, timing=timing, phantom_radius_pix=self.Phantom_Radius_Pix,
+                                   phantom_radius_mm=self.Phantom_Radius_mm)
+        else:
+            logging.warning(r"Series is not completely initialized, skip storing in database")
+            return
+    # End of connect_database
+    ##################################################
+
+# End of class DicomSeries
+#######################################################################
+
+
+def analyze_file(filename, center=0, width=100, show_image=True, low_memory=False, measure_memory=False,
+                 dataset=None, timer=None, polar=False):
+    """
+    Analyze one file and return its AssessmentResult, dataset is the file if it is already read
+    and timer the StageTimer that timed its reading. With polar, the sector profiles are calculated too.
+    This is the job of the worker processes, every error is caught and returned in the result,
+    so a malformed file never stops the batch.
+    With measure_memory, the peak memory allocated while analyzing the file is traced with tracemalloc
+    (which slows the analysis down) and returned in peak_memory, in bytes.
+    """
+    try:
+        if measure_memory:
+            # only what is allocated for this file counts, not what the process already holds
+            tracemalloc.start()
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        temp = Dicom(center=center, width=width, filename=filename, low_memory=low_memory, dataset=dataset,
+                     timer=timer, polar=polar)
+        if show_image:
+            temp.show_image()
+        result = temp.to_result()
+        if measure_memory:
+            result = result._replace(peak_memory=tracemalloc.get_traced_memory()[1] - baseline)
+        return result
+    except Exception as e:
+        logging.error(r"%s: %s", filename, e)
+        return AssessmentResult(filename, error=str(e))
+#######################################################################
+
+
+def analyze_files(filenames, workers=1, center=0, width=100, show_image=True, low_memory=False,
+                  measure_memory=False, polar=False):
+    """
+    Generator of the AssessmentResult of every file, in the same order as filenames.
+    With workers > 1 the files are analyzed by a process pool. If a worker process crashes, the pool is broken:
+    the 1st unfinished file is then analyzed alone in its own process, so only the faulty file is lost,
+    and a new pool is started for the rest of the files.
+    """
+    filenames = list(filenames)
+    if workers <= 1:
+        for x in filenames:
+            yield analyze_file(x, center, width, show_image, low_memory, measure_memory, polar=polar)
+        return
+    start = 0
+    while start < len(filenames):
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(analyze_file, x, center, width, show_image, low_memory, measure_memory,
+                                       polar=polar)
+                       for x in filenames[start:]]
+            for future in futures:
+                try:
+                    result = future.result()
+                except BrokenProcessPool:
+                    break
+                start += 1
+                yield result
+        if start < len(filenames):
+            logging.error(r"Worker process crashed, analyze %s alone.", filenames[start])
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                try:
+                    result = executor.submit(analyze_file, filenames[start], center, width, show_image, low_memory,
+                                             measure_memory, polar=polar).result()
+                except BrokenProcessPool:
+                    result = AssessmentResult(filenames[start], error=r"Worker process crashed")
+            start += 1
+            yield result
+#######################################################################
+
+
+def iter_assessments(paths, prefetch=4, center=0, width=100, show_image=True, low_memory=False,
+                     measure_memory=False, polar=False):
+    """
+    Generator of the AssessmentResult of every file of paths (files or folders, see discover_files),
+    one at a time and in order.
+    The next prefetch files are read by a pool of background threads while the current one is calculated,
+    so the disk / network latency is hidden behind the calculation. No more than prefetch files wait
+    in memory, however many files there are:
+        for result in iter_assessments(["/data/archive/"], prefetch=8):
+            writer.add_result(result)
+    """
+    prefetch = max(1, prefetch)
+    filenames = discover_files(paths)
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=prefetch) as executor:
+        for x in itertools.islice(filenames, prefetch):
+            timer = StageTimer()
+            pending.append((x, timer, executor.submit(read_dicom, x, timer)))
+        while pending:
+            filename, timer, future = pending.popleft()
+            # keep prefetch files reading while this one is calculated
+            for x in itertools.islice(filenames, 1):
+                next_timer = StageTimer()
+                pending.append((x, next_timer, executor.submit(read_dicom, x, next_timer)))
+            entry, dataset = future.result()
+            del future
+            if dataset is None:
+                logging.error(r"%s is rejected: %s", filename, entry.reason)
+                yield AssessmentResult(filename, timing=timer.as_dict(), error=r"rejected: " + entry.reason)
+                continue
+            result = analyze_file(filename, center, width, show_image, low_memory, measure_memory, dataset,
+                                  timer, polar)
+            # release the dataset before waiting for the caller, so the memory stays capped
+            del dataset
+            yield result
+#######################################################################
+
+
+# inline: images are saved by the analysis, deferred: figures are rendered from the database after the analysis
+Render_Modes = ("none", "deferred", "inline")
+
+
 def main():
+    parser = argparse.ArgumentParser(usage="python BandAssessment.py [filename]|[folder name]")
+    parser.add_argument("path", nargs="?", help="a dicom file or a folder of dicom files")
+    parser.add_argument("--migrate", action="store_true",
+                        help="convert " + SQL3Handler.Database_Name + " of an older version to the current schema")
+    parser.add_argument("--series", action="store_true",
+                        help="group the files of a folder by series and calculate every series at once")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes to analyze the files of a folder (default: 1)")
+    parser.add_argument("--prefetch", type=int, default=4,
+                        help="number of files read ahead by background threads when --workers is 1 (default: 4)")
+    parser.add_argument("--batch-size", type=int, default=500,
+                        help="number of records written to the database in one transaction (default: 500)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="skip the files of a folder that are already in the database and not changed since")
+    parser.add_argument("--manifest", metavar="CSV",
+                        help="pre-scan the headers of a folder, write the accepted / rejected files to CSV "
+                             "and only analyze the accepted ones")
+    parser.add_argument("--render", choices=Render_Modes, default="inline",
+                        help="inline: save the images while analyzing (default), deferred: save the figures "
+                             "from the stored profiles after the analysis, none: save no image")
+    parser.add_argument("--low-memory", action="store_true",
+                        help="calculate in float32 and keep only one image buffer per file")
+    parser.add_argument("--memory-report", action="store_true",
+                        help="trace and report the peak memory used to analyze every file (slower)")
+    parser.add_argument("--polar", action="store_true",
+                        help="also resample the images on a (radius x angle) grid and calculate the profile of "
+                             "every sector, to locate the bands on a part of the circle")
+    parser.add_argument("--profile", action="store_true",
+                        help="print the wall and cpu time of every stage of the analysis at the end of the run")
+    parser.add_argument("--store-timing", action="store_true",
+                        help="store the stage timings of every record in the database")
+    parser.add_argument("--log-file", default="running.log",
+                        help="file the log is appended to (default: running.log)")
+    parser.add_argument("--log-level", choices=("DEBUG", "INFO", "WARNING", "ERROR"), default="INFO",
+                        help="level of the messages written to the log file (default: INFO)")
+    args = parser.parse_args()
+    configure_logging(args.log_file, args.log_level)
     logging.debug(r"here is the main program")
-    # if only call the script, will use ./a.dcm as input
-    if len(sys.argv) == 1:
+    inline = args.render == "inline"
+    # timings of all the files, series and database writes of the run
+    run_timer = StageTimer()
+    if args.migrate:
+        SQL3Handler.migrate()
+    # if only call the script, print the usage
+    elif args.path is None:
         print("Use the script as below:")
         print("python BandAssessment.py [filename]|[folder name]")
-    # if with 1 parameter
-    elif len(sys.argv) == 2:
-        logging.debug(r"Program has 1 parameters.")
-        # if a folder is given
-        if os.path.isdir(sys.argv[1]):
-            logging.debug(r"The parameter is a folder!")
-            dicom_path = sys.argv[1]
-            # the path must have a end of / or \
-            if (dicom_path[-1] != "/") and (dicom_path[-1] != "\\"):
-                dicom_path += "/"
-                logging.warning(r"There should have a \\ at the end of path, automatically add \\")
-            # list all files in the folder
-            dicom_dir_list = os.listdir(dicom_path)
-            for x in dicom_dir_list:
-                temp = Dicom(center=0, width=100, filename=dicom_path + x)
-                temp.show_image()
-                temp.connect_database()
-        # if a file is given
-        elif os.path.isfile(sys.argv[1]):
-            logging.debug(r"The parameter is a file!")
-            temp = Dicom(center=0, width=100, filename=sys.argv[1])
+    # if a folder is given
+    elif os.path.isdir(args.path):
+        logging.debug(r"The parameter is a folder!")
+        # list all dicom files in the folder and its sub folders. An incremental run checks the DICM marker
+        # of the new and changed files only, the unchanged ones are never opened
+        dicom_dir_list = list(discover_files([args.path], check_preamble=not args.incremental))
+        logging.info(r"%s dicom files found in %s", len(dicom_dir_list), args.path)
+        try:
+            writer = SQL3Writer(batch_size=args.batch_size, store_timing=args.store_timing)
+        except sqlite3.DatabaseError as e:
+            logging.error(str(e))
+            return
+        with writer:
+            uid_from = writer.last_uid() + 1
+            if args.incremental:
+                dicom_dir_list = select_new_files(dicom_dir_list, writer)
+            if args.manifest or args.series:
+                manifest = prescan(dicom_dir_list)
+                if args.manifest:
+                    write_manifest(manifest, args.manifest)
+                dicom_dir_list = [x.file_name for x in manifest if x.accepted]
+            # every analyzed file is recorded in the ledger, for the next incremental run
+            if args.series:
+                # the series are grouped from the headers, then read one at a time
+                for files in group_series(manifest):
+                    for series in DicomSeries.from_files(files, center=0, width=100, timer=run_timer,
+                                                         polar=args.polar):
+                        if inline:
+                            series.show_image()
+                        series.connect_database(writer)
+                        run_timer.add(series.Timer)
+                        for filename, header in zip(series.Dicom_File_Names, series.Headers):
+                            writer.add_processed(filename, file_stat(filename), header["Dicom_SOP_Instance_UID"])
+            else:
+                peaks = []
+                if args.workers > 1:
+                    results = analyze_files(dicom_dir_list, workers=args.workers, center=0, width=100,
+                                            show_image=inline, low_memory=args.low_memory,
+                                            measure_memory=args.memory_report, polar=args.polar)
+                else:
+                    results = iter_assessments(dicom_dir_list, prefetch=args.prefetch, center=0, width=100,
+                                               show_image=inline, low_memory=args.low_memory,
+                                               measure_memory=args.memory_report, polar=args.polar)
+                for result in results:
+                    run_timer.add(result.timing)
+                    if result.peak_memory is not None:
+                        peaks.append(result.peak_memory)
+                        logging.debug(r"%s: peak memory %s bytes", result.file_name, result.peak_memory)
+                    if result.error is None:
+                        writer.add_result(result)
+                        writer.add_processed(result.file_name, file_stat(result.file_name),
+                                             result.header["Dicom_SOP_Instance_UID"])
+                    else:
+                        logging.warning(r"%s: %s, skip storing in database", result.file_name, result.error)
+                        # a rejected file is recorded with its reason, as select_new_files does, so the next
+                        # incremental run skips it. The failed files are tried again
+                        if result.error.startswith(r"rejected: "):
+                            status = result.error[len(r"rejected: "):]
+                        else:
+                            status = r"error: " + result.error
+                        writer.add_processed(result.file_name, file_stat(result.file_name), None, status)
+                if peaks:
+                    logging.info(r"Peak memory per file: max %.1f MiB, mean %.1f MiB", max(peaks) / 2 ** 20,
+                                 sum(peaks) / len(peaks) / 2 ** 20)
+        run_timer.add(writer.Timer)
+        if args.render == "deferred":
+            with run_timer.stage("render"):
+                render_profiles(SQL3Handler.query(uid_from=uid_from), os.path.join(args.path, ""))
+    # if a file is given
+    elif os.path.isfile(args.path):
+        logging.debug(r"The parameter is a file!")
+        # the database is opened first, so an old schema is reported before the file is analyzed
+        try:
+            writer = SQL3Writer(batch_size=args.batch_size, store_timing=args.store_timing)
+        except sqlite3.DatabaseError as e:
+            logging.error(str(e))
+            return
+        if args.memory_report:
+            tracemalloc.start()
+        temp = Dicom(center=0, width=100, filename=args.path, low_memory=args.low_memory, timer=run_timer,
+                     polar=args.polar)
+        if inline:
             temp.show_image()
-            temp.connect_database()
-        else:
-            print("Use the script as below:")
-            print("python BandAssessment.py [filename]|[folder name]")
+        if args.memory_report:
+            logging.info(r"Peak memory: %.1f MiB", tracemalloc.get_traced_memory()[1] / 2 ** 20)
+        temp.release_pixels()
+        with writer:
+            uid_from = writer.last_uid() + 1
+            temp.connect_database(writer)
+        run_timer.add(writer.Timer)
+        if args.render == "deferred":
+            with run_timer.stage("render"):
+                render_profiles(SQL3Handler.query(uid_from=uid_from), os.path.join(os.path.dirname(args.path), ""),
+                                overlay=False)
+    else:
+        print("Use the script as below:")
+        print("python BandAssessment.py [filename]|[folder name]")
+    if args.profile and run_timer.Timings:
+        print(run_timer.report())
 
 
 # if it is not called by a module
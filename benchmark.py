@@ -0,0 +1,356 @@
+import sys
+import os
+import argparse
+import collections
+import json
+import platform
+import shutil
+import tempfile
+import time
+import uuid
+import logging
+import dicom
+from dicom.dataset import Dataset
+from dicom.dataset import FileDataset
+import numpy as np
+import BandAssessment
+
+
+##############################################################
+# Benchmark of the BandAssessment pipeline on synthetic phantoms, no patient data is needed.
+# Usage:
+#     python benchmark.py [--output result.json] [--reference benchmark_reference.json]
+# The phantoms are written to a temporary folder, every stage is timed per image and per series,
+# the database writer at several batch sizes and the folder analysis at several worker counts.
+# The profiles are compared with a reference file, which is created if it does not exist yet.
+##############################################################
+
+# reference profiles committed with the script, made by a known good version with the default --images
+Reference_Name = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_reference.json")
+
+# one synthetic phantom series. rings is a tuple of (radius in mm, HU offset, width in mm) band artifacts,
+# off_center is the (row, col) shift of the phantom in pixels and noise the standard deviation in HU
+PhantomCase = collections.namedtuple("PhantomCase",
+                                     ["name", "diameter", "rings", "noise", "off_center", "station_name"],
+                                     defaults=((), 5.0, (0, 0), "10001"))
+
+Default_Cases = (PhantomCase("20cm_centered", 200),
+                 PhantomCase("30cm_centered", 300, station_name="10002"),
+                 PhantomCase("20cm_rings", 200, rings=((30, 8, 1.0), (60, -6, 1.5), (85, 4, 0.8))),
+                 PhantomCase("30cm_off_center", 300, rings=((50, 6, 1.0),), off_center=(14, -11),
+                             station_name="10002"),
+                 PhantomCase("20cm_noisy", 200, rings=((40, 5, 1.0),), noise=20.0))
+
+Image_Size = 512
+# acrylic shell around the water of the phantom
+Shell_Thickness = 3.0
+Shell_HU = 120
+Air_HU = -1000
+
+
+def phantom_image(case, instance, size=Image_Size):
+    """
+    Stored pixel values (intercept -1024) of one slice of a phantom, and the pixel spacing in mm.
+    The noise is seeded by the case name and the instance, so the images are the same in every run.
+    """
+    # the field of view is a bit larger than the phantom
+    pix_space = round((case.diameter + 50.0) / size, 6)
+    rows, cols = np.mgrid[:size, :size]
+    distance = np.hypot(rows - (size / 2 + case.off_center[0]), cols - (size / 2 + case.off_center[1])) * pix_space
+    radius = case.diameter / 2.0
+    image = np.full((size, size), float(Air_HU))
+    image[distance < radius] = Shell_HU
+    water = distance < radius - Shell_Thickness
+    image[water] = 0
+    for ring_radius, offset, width in case.rings:
+        image[water] += offset * np.exp(-0.5 * ((distance[water] - ring_radius) / width) ** 2)
+    seed = uuid.uuid5(uuid.NAMESPACE_URL, case.name + "/" + str(instance)).int % 2 ** 32
+    image[water] += np.random.default_rng(seed).normal(0, case.noise, int(water.sum()))
+    return np.clip(np.round(image + 1024), 0, 4095).astype(np.uint16), pix_space
+
+
+def make_uid(name):
+    # UID derived from a name (2.25 root with an UUID), the same in every run
+    return "2.25." + str(uuid.uuid5(uuid.NAMESPACE_URL, name).int)
+
+
+def write_phantom(filename, case, instance, series=1):
+    """
+    Write one slice of a phantom as a Band Assessment dicom file.
+    """
+    pixels, pix_space = phantom_image(case, instance)
+    uid = make_uid(case.name + "/" + str(series) + "/" + str(instance))
+    meta = Dataset()
+    meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.2"  # CT Image Storage
+    meta.MediaStorageSOPInstanceUID = uid
+    meta.TransferSyntaxUID = "1.2.840.10008.1.2.1"  # explicit VR little endian
+    meta.ImplementationClassUID = make_uid("BandAssessment benchmark")
+    dataset = FileDataset(filename, {}, file_meta=meta, preamble=b"\0" * 128)
+    dataset.is_little_endian = True
+    dataset.is_implicit_VR = False
+    dataset.SOPClassUID = meta.MediaStorageSOPClassUID
+    dataset.SOPInstanceUID = uid
+    dataset.StudyDate = "20170101"
+    dataset.StudyDescription = "Band Assessment"
+    dataset.DeviceSerialNumber = case.station_name
+    # the IS / DS values are given as text, pydicom 0.9.9 can not write the numbers it converts itself
+    dataset.KVP = "120"
+    dataset.XRayTubeCurrent = "200"
+    dataset.ConvolutionKernel = "B30f"
+    dataset.SliceThickness = "5"
+    dataset.add_new((0x0018, 0x9307), "FD", 19.2)  # Total Collimation Width
+    dataset.SeriesNumber = str(series)
+    dataset.InstanceNumber = str(instance)
+    dataset.RescaleSlope = "1"
+    dataset.RescaleIntercept = "-1024"
+    dataset.Rows, dataset.Columns = pixels.shape
+    dataset.PixelSpacing = ["%.6f" % pix_space, "%.6f" % pix_space]
+    dataset.SamplesPerPixel = 1
+    dataset.PhotometricInterpretation = "MONOCHROME2"
+    dataset.BitsAllocated = 16
+    dataset.BitsStored = 16
+    dataset.HighBit = 15
+    dataset.PixelRepresentation = 0
+    dataset.PixelData = pixels.tobytes()
+    dataset[0x7fe0, 0x0010].VR = "OW"
+    dataset.save_as(filename)
+
+
+def write_phantoms(folder, cases, images):
+    """
+    Write images slices of every case in its own sub folder of folder.
+    Return {case name: list of file names}.
+    """
+    files = {}
+    for series, case in enumerate(cases, 1):
+        os.makedirs(os.path.join(folder, case.name), exist_ok=True)
+        files[case.name] = []
+        for instance in range(1, images + 1):
+            filename = os.path.join(folder, case.name, "IM" + str(instance).zfill(4) + ".dcm")
+            write_phantom(filename, case, instance, series)
+            files[case.name].append(filename)
+    return files
+##############################################################
+
+
+def timed(function, *args, **kwargs):
+    # return (the result of function, the seconds it took)
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def summary(seconds):
+    # statistics of a list of durations, in milliseconds
+    seconds = np.array(seconds) * 1000
+    return {"count": len(seconds), "mean_ms": float(seconds.mean()), "median_ms": float(np.median(seconds)),
+            "min_ms": float(seconds.min()), "max_ms": float(seconds.max())}
+
+
+def time_image_stages(filenames, repeat):
+    """
+    Time every stage of the analysis of one image, for all the files, repeat times each.
+    The stages are timed on their own on the same Dicom object, init is the whole Dicom constructor.
+    Return ({stage: summary}, {file name: vectorized profile}, max difference of the bresenham profiles).
+    """
+    stages = collections.OrderedDict((x, []) for x in ("read", "init", "calc_circle", "integration",
+                                                       "integration_bresenham", "median_filter", "polar",
+                                                       "show_image"))
+    profiles = {}
+    bresenham_difference = 0.0
+    for filename in filenames:
+        for _ in range(repeat):
+            (entry, dataset), seconds = timed(BandAssessment.read_dicom, filename)
+            stages["read"].append(seconds)
+            image, seconds = timed(BandAssessment.Dicom, filename, dataset=dataset)
+            stages["init"].append(seconds)
+            stages["calc_circle"].append(timed(image.calc_circle)[1])
+            stages["integration"].append(timed(image.integration)[1])
+            profile = image.Integration_Result.copy()
+            stages["median_filter"].append(timed(BandAssessment.median_filter, profile)[1])
+            stages["polar"].append(timed(image.polar_analysis)[1])
+            # the legacy loop adds to the integration result, so it starts from zeros
+            image.Integration_Method = "bresenham"
+            image.Integration_Result = np.zeros(image.Radius)
+            stages["integration_bresenham"].append(timed(image.integration)[1])
+            bresenham_difference = max(bresenham_difference,
+                                       float(np.abs(image.Integration_Result - profile).max()))
+            stages["show_image"].append(timed(image.show_image)[1])
+            profiles[filename] = profile
+    return dict((name, summary(x)) for name, x in stages.items()), profiles, bresenham_difference
+
+
+def time_series(files, repeat):
+    """
+    Time DicomSeries (read, stack and integrate the whole series) of every case.
+    Return {case name: summary}.
+    """
+    result = {}
+    for name, filenames in files.items():
+        result[name] = summary([timed(BandAssessment.DicomSeries.from_files, filenames)[1] for _ in range(repeat)])
+        result[name]["images"] = len(filenames)
+        result[name]["mean_ms_per_image"] = result[name]["mean_ms"] / len(filenames)
+    return result
+
+
+def time_batch_sizes(results, batch_sizes, records, folder):
+    """
+    Time SQL3Writer storing records records (the results repeated) at every batch size, in a new database
+    of folder.
+    Return {batch size: {seconds, records_per_second}}.
+    """
+    timing = {}
+    for batch_size in batch_sizes:
+        database_name = os.path.join(folder, "batch_" + str(batch_size) + ".db")
+        start = time.perf_counter()
+        with BandAssessment.SQL3Writer(database_name, batch_size=batch_size) as writer:
+            for index in range(records):
+                header = results[index % len(results)].header
+                # no SOP Instance UID, so the repeated results are all kept
+                writer.add_row(header["Dicom_Station_Name"], header["Dicom_KVP"], header["Dicom_Current"],
+                               header["Dicom_Kernel"], header["Dicom_Total_Collimation"],
+                               header["Dicom_Slice_Thickness"], header["Dicom_Instance"],
+                               results[index % len(results)].integration_result, header["Dicom_Study_Date"])
+        seconds = time.perf_counter() - start
+        timing[str(batch_size)] = {"records": records, "seconds": seconds, "records_per_second": records / seconds}
+    return timing
+
+
+def time_workers(filenames, workers_list, prefetch):
+    """
+    Time the analysis of all the files without images, by analyze_files at every worker count
+    and by iter_assessments with prefetch. Return ({name: {seconds, images_per_second}}, results).
+    """
+    timing = {}
+    results = None
+    for workers in workers_list:
+        results, seconds = timed(list, BandAssessment.analyze_files(filenames, workers=workers, show_image=False))
+        timing["workers_" + str(workers)] = {"images": len(filenames), "seconds": seconds,
+                                             "images_per_second": len(filenames) / seconds}
+    results, seconds = timed(list, BandAssessment.iter_assessments(filenames, prefetch=prefetch, show_image=False))
+    timing["prefetch_" + str(prefetch)] = {"images": len(filenames), "seconds": seconds,
+                                           "images_per_second": len(filenames) / seconds}
+    return timing, results
+##############################################################
+
+
+def check_parity(profiles, reference_name, tolerance):
+    """
+    Compare the profiles with the ones of the reference file, keyed by case and file name.
+    The reference file is written if it does not exist yet.
+    Return the parity report.
+    """
+    if not os.path.isfile(reference_name):
+        with open(reference_name, "w") as fp:
+            json.dump(dict((x, y.tolist()) for x, y in profiles.items()), fp)
+        return {"reference": reference_name, "status": "created", "profiles": len(profiles)}
+    with open(reference_name) as fp:
+        reference = json.load(fp)
+    report = {"reference": reference_name, "tolerance": tolerance, "profiles": len(profiles), "missing": [],
+              "failed": [], "max_abs_difference": 0.0}
+    for name, profile in profiles.items():
+        if name not in reference:
+            report["missing"].append(name)
+            continue
+        expected = np.array(reference[name])
+        if expected.shape != profile.shape:
+            report["failed"].append(name)
+            continue
+        difference = float(np.abs(profile - expected).max())
+        report["max_abs_difference"] = max(report["max_abs_difference"], difference)
+        if difference > tolerance:
+            report["failed"].append(name)
+    report["status"] = "passed" if not report["failed"] and not report["missing"] else "failed"
+    return report
+
+
+def check_band_scores(files, results):
+    """
+    Score the profile of every phantom with BandAssessment.score_profile (no baseline). The phantoms without
+    rings must score 0 bands, a band there means that the shell or the edge of the phantom is scored.
+    Return the report: band counts and peak deviations per case, the failed files and the status.
+    """
+    cases = dict((x, case) for case in Default_Cases for x in files[case.name])
+    report = {"band_count": {}, "peak_deviation": {}, "failed": []}
+    for result in results:
+        if result.error is not None:
+            continue
+        case = cases[result.file_name]
+        score = BandAssessment.score_profile(result.integration_result, None, result.phantom_radius_pix,
+                                             result.phantom_radius_mm)
+        report["band_count"].setdefault(case.name, []).append(score.band_count)
+        report["peak_deviation"].setdefault(case.name, []).append(score.peak_deviation)
+        if not case.rings and score.band_count != 0:
+            report["failed"].append(result.file_name)
+    report["status"] = "passed" if not report["failed"] else "failed"
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(usage="python benchmark.py [options]")
+    parser.add_argument("--images", type=int, default=4, help="slices per phantom series (default: 4)")
+    parser.add_argument("--repeat", type=int, default=3, help="timing repeats per image (default: 3)")
+    parser.add_argument("--batch-sizes", default="1,50,500",
+                        help="comma separated batch sizes of the database writer (default: 1,50,500)")
+    parser.add_argument("--records", type=int, default=2000,
+                        help="records written at every batch size (default: 2000)")
+    parser.add_argument("--workers", default="1,2,4", help="comma separated worker counts (default: 1,2,4)")
+    parser.add_argument("--prefetch", type=int, default=4, help="read ahead of iter_assessments (default: 4)")
+    parser.add_argument("--reference", default=Reference_Name,
+                        help="reference profiles, created if it does not exist (default: benchmark_reference.json "
+                             "next to the script)")
+    parser.add_argument("--tolerance", type=float, default=1e-6,
+                        help="largest accepted difference from the reference profiles, in HU (default: 1e-6)")
+    parser.add_argument("--output", help="write the JSON result to this file instead of the screen")
+    parser.add_argument("--keep", metavar="FOLDER", help="write the phantoms to FOLDER and keep them")
+    args = parser.parse_args()
+    # the benchmark measures the calculation, not the log. The phantoms with ring artifacts are flagged
+    # out of tolerance against the clean ones of the same scanner, these warnings are expected
+    logging.getLogger().setLevel(logging.ERROR)
+    folder = args.keep or tempfile.mkdtemp(prefix="band_benchmark_")
+    # the databases of the batch sizes are never mixed with the phantoms, even if they are kept
+    database_folder = tempfile.mkdtemp(prefix="band_benchmark_db_")
+    try:
+        files, seconds = timed(write_phantoms, folder, Default_Cases, args.images)
+        filenames = [x for name in files for x in files[name]]
+        stages, profiles, bresenham_difference = time_image_stages(filenames, args.repeat)
+        workers, results = time_workers(filenames, [int(x) for x in args.workers.split(",")], args.prefetch)
+        report = {
+            "environment": {"python": platform.python_version(), "numpy": np.__version__,
+                            "pydicom": dicom.__version__, "platform": platform.platform(),
+                            "cpu_count": os.cpu_count()},
+            "cases": [x._asdict() for x in Default_Cases],
+            "images": len(filenames),
+            "phantom_generation_seconds": seconds,
+            "image_stages": stages,
+            "series": time_series(files, args.repeat),
+            "batch_sizes": time_batch_sizes([x for x in results if x.error is None],
+                                            [int(x) for x in args.batch_sizes.split(",")], args.records,
+                                            database_folder),
+            "workers": workers,
+            "circles": dict((x.file_name[len(folder) + 1:], {"center_row": x.phantom_center_row,
+                                                             "center_col": x.phantom_center_col,
+                                                             "radius_mm": x.phantom_radius_mm,
+                                                             "radius": x.radius}) for x in results),
+            "parity": check_parity(dict((x[len(folder) + 1:].replace(os.sep, "/"), y) for x, y in profiles.items()),
+                                   args.reference, args.tolerance),
+        }
+        report["parity"]["bresenham_max_abs_difference"] = bresenham_difference
+        report["band_scores"] = check_band_scores(files, results)
+    finally:
+        shutil.rmtree(database_folder, ignore_errors=True)
+        if not args.keep:
+            shutil.rmtree(folder, ignore_errors=True)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as fp:
+            fp.write(text)
+    else:
+        print(text)
+    # a failed parity or band score check fails the run, so it can be used in a script
+    return 1 if "failed" in (report["parity"]["status"], report["band_scores"]["status"]) else 0
+
+
+# if it is not called by a module
+if __name__ == '__main__':
+    sys.exit(main())